@@ -1,13 +1,19 @@
 import connexion
 from connexion import NoContent
-import json
 import yaml
 import logging
 import logging.config
-from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from threading import Thread, Lock
+from collections import OrderedDict
+from event_index import EventIndex
+from kafka_pool import KafkaPool
+import codec
+import validation
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import os
+import time
 
 
 
@@ -33,92 +39,144 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+EVENT_INDEX = EventIndex()
+# Settings missing from configs of older versions take the defaults of app_conf.yml
+CACHE_SIZE = app_config.get("index", {}).get("cache_size", 1000)
+PAYLOAD_CACHE = OrderedDict()
+CACHE_LOCK = Lock()
+KAFKA_POOL = KafkaPool("%s:%d" % (app_config["events"]["hostname"],
+                                  app_config["events"]["port"]))
+
+def index_events():
+    """ Indexes the location of every event in the topic """
+    checkpoint_file = app_config.get("checkpoint", {}).get("filename", "event_index.json")
+    checkpoint_interval = app_config.get("checkpoint", {}).get("interval_sec", 5)
+    topic = KAFKA_POOL.topic(app_config["events"]["topic"])
+    # Read the topic from the beginning, then keep blocking on new
+    # messages so the index stays current for the lifetime of the service.
+    # The consumer timeout wakes the loop up so the checkpoint is also
+    # written when no new messages arrive.
+    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
+                                         auto_offset_reset=OffsetType.EARLIEST,
+                                         consumer_timeout_ms=checkpoint_interval * 1000)
+    if EVENT_INDEX.load(checkpoint_file):
+        # Resume after the last checkpointed offsets instead of rescanning
+        last_offsets = EVENT_INDEX.last_offsets()
+        consumer.reset_offsets([(topic.partitions[partition_id], offset)
+                                for partition_id, offset in last_offsets.items()
+                                if partition_id in topic.partitions])
+        logger.info(f"Resumed event index from checkpoint at offsets {last_offsets}")
+    logger.info("Started indexing events")
+
+    last_checkpoint = time.monotonic()
+    pending = 0
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            try:
+                event_type = codec.decode_event(msg.value).get("type")
+            except Exception as e:
+                # Recorded without a type, so the checkpoint moves past it
+                logger.error(f"Skipping malformed message at offset {msg.offset} "
+                             f"of partition {msg.partition_id}: {e}")
+                event_type = None
+            if not EVENT_INDEX.add(event_type, msg.partition_id, msg.offset) and event_type is not None:
+                logger.warning(f"Unknown event type: {event_type}")
+            pending += 1
+
+        if pending and time.monotonic() - last_checkpoint >= checkpoint_interval:
+            EVENT_INDEX.save(checkpoint_file)
+            last_checkpoint = time.monotonic()
+            pending = 0
+            logger.debug(f"Checkpointed event index at offsets {EVENT_INDEX.last_offsets()}")
+
+def fetch_payload(event_type, partition_id, offset):
+    """ Fetches the payload of the event of a type at a partition and
+    offset, or None if the offset no longer holds it """
+    with KAFKA_POOL.consumer(app_config["events"]["topic"],
+                             partition_ids=[partition_id],
+                             consumer_timeout_ms=1000) as consumer:
+        partition = consumer.partitions[partition_id]
+
+        # reset_offsets takes the last consumed offset, and -1 would mean
+        # the latest offset, so the first message is reached with EARLIEST
+        last_offset = offset - 1 if offset > 0 else OffsetType.EARLIEST
+        with KAFKA_POOL.timed('fetch'):
+            consumer.reset_offsets([(partition, last_offset)])
+            while True:
+                msg = consumer.consume()
+                if msg is None:
+                    return None
+                if msg.offset == offset:
+                    break
+                if msg.offset > offset:
+                    # Retention deleted the offset, the consumer was reset past it
+                    logger.warning(f"Offset {offset} of partition {partition_id} is no longer in the topic")
+                    return None
+
+    event = codec.decode_event(msg.value)
+    if event.get('type') != event_type:
+        logger.warning(f"Offset {offset} of partition {partition_id} holds a {event.get('type')} event, "
+                       f"not a {event_type} event")
+        return None
+    return event['payload']
+
+def get_event(event_type, index):
+    """ Gets the event of a type at an index, from the cache or Kafka """
+    logger.info("Retrieving %s event at index %d" % (event_type, index))
+    key = (event_type, index)
+    with CACHE_LOCK:
+        if key in PAYLOAD_CACHE:
+            PAYLOAD_CACHE.move_to_end(key)
+            return PAYLOAD_CACHE[key], 200
+
+    location = EVENT_INDEX.lookup(event_type, index)
+    payload = None
+    if location is not None:
+        try:
+            payload = fetch_payload(event_type, *location)
+        except Exception as e:
+            logger.error(f"Failed to fetch {event_type} event at index {index}: {e}")
+
+    if payload is None:
+        logger.error("Could not find %s event at index %d" % (event_type, index))
+        return { "message": "Not Found"}, 404
+
+    with CACHE_LOCK:
+        PAYLOAD_CACHE[key] = payload
+        if len(PAYLOAD_CACHE) > CACHE_SIZE:
+            PAYLOAD_CACHE.popitem(last=False)
+    return payload, 200
+
 def get_books_buy_event(index):
     """ Get book buy event in History """
-    hostname = "%s:%d" % (app_config["events"]["hostname"],
-                          app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-
-    # Here we reset the offset on start so that we retrieve
-    # messages at the beginning of the message queue.
-    # To prevent the for loop from blocking, we set the timeout to
-    # 100ms. There is a risk that this loop never stops if the
-    # index is large and messages are constantly being received!
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,consumer_timeout_ms=1000)
-    logger.info("Retrieving buy event at index %d" % index)
-    try:
-        current_index = 0
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg.get("type") == 'buy':
-                if current_index == index:
-                    return msg['payload'], 200
-                current_index += 1
-                
-    except:
-        logger.error("No more messages found")
-    
-    logger.error("Could not find buy event at index %d" % index)
-    return { "message": "Not Found"}, 404
+    return get_event('buy', index)
 
 def get_books_sell_event(index):
     """ Get book sell event in History """
-    hostname = "%s:%d" % (app_config["events"]["hostname"],
-                          app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,consumer_timeout_ms=1000)
-    logger.info("Retrieving sell event at index %d" % index)
-    try:
-        current_index = 0
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg.get("type") == 'sell':
-                if current_index == index:
-                    return msg['payload'], 200
-                current_index += 1
-                
-    except:
-        logger.error("No more messages found")
-    
-    logger.error("Could not find sell event at index %d" % index)
-    return { "message": "Not Found"}, 404
+    return get_event('sell', index)
 
 def get_stats():
     """ Gets event stats in History """
-    hostname = "%s:%d" % (app_config["events"]["hostname"],
-                          app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,consumer_timeout_ms=1000)
-    num_buy_events = 0
-    num_sell_events = 0
     logger.info("Retrieving event stats")
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg.get("type") == 'sell':
-                num_sell_events += 1
-            if msg.get("type") == 'buy':
-                num_buy_events += 1
-        return {
-                    "num_buy_events": num_buy_events,
-                    "num_sell_events": num_sell_events
-                }, 200
-            
-    except:
-        logger.error("No more messages found")
-    
-    logger.error("Could not event stats")
-    return { "message": "Not Found"}, 404
-
-
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/analyzer",strict_validation=True,validate_responses=True)
+    return {
+                "num_buy_events": EVENT_INDEX.count('buy'),
+                "num_sell_events": EVENT_INDEX.count('sell')
+            }, 200
+
+def get_kafka_stats():
+    """ Gets the Kafka connection and fetch latency counters """
+    return KAFKA_POOL.stats(), 200
+
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+validation.configure(app_config.get('validation'))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/analyzer",strict_validation=True,validate_responses=True,
+            validator_map=validation.VALIDATOR_MAP)
 app.add_middleware(
     CORSMiddleware,
     position=MiddlewarePosition.BEFORE_EXCEPTION,
@@ -133,4 +191,8 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     app.app.config['CORS_HEADERS'] = 'Content-Type'
 
 if __name__ == "__main__":
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
+    t1 = Thread(target=index_events)
+    t1.setDaemon(True)
+    t1.start()
     app.run(host="0.0.0.0",port=8110)
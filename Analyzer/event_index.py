@@ -0,0 +1,110 @@
+from array import array
+from threading import Lock
+import json
+import os
+
+
+class EventIndex:
+    """ Maps the ordinal of each event type to its Kafka partition and offset """
+
+    def __init__(self, event_types=('buy', 'sell')):
+        """ Initializes an empty index for the given event types """
+        self._lock = Lock()
+        self._partitions = {event_type: array('i') for event_type in event_types}
+        self._offsets = {event_type: array('q') for event_type in event_types}
+        self._last_offsets = {}
+        self._saved_counts = {event_type: 0 for event_type in event_types}
+
+    def add(self, event_type, partition_id, offset):
+        """ Records the location of the next event of a type """
+        with self._lock:
+            self._last_offsets[partition_id] = offset
+            if event_type not in self._offsets:
+                return False
+            self._partitions[event_type].append(partition_id)
+            self._offsets[event_type].append(offset)
+        return True
+
+    def lookup(self, event_type, index):
+        """ Returns the (partition_id, offset) of an event, or None """
+        if event_type not in self._offsets:
+            return None
+        with self._lock:
+            if index < 0 or index >= len(self._offsets[event_type]):
+                return None
+            return self._partitions[event_type][index], self._offsets[event_type][index]
+
+    def count(self, event_type):
+        """ Number of indexed events of a type """
+        with self._lock:
+            return len(self._offsets[event_type])
+
+    def last_offsets(self):
+        """ Last processed offset of each partition """
+        with self._lock:
+            return dict(self._last_offsets)
+
+    def save(self, filename):
+        """ Checkpoints the counters and offsets to disk
+
+        The index arrays are appended to files next to the checkpoint, so
+        each save only writes the entries added since the previous one. The
+        JSON checkpoint is replaced atomically last and holds the number of
+        entries that are valid in the array files.
+        """
+        with self._lock:
+            counts = {event_type: len(offsets) for event_type, offsets in self._offsets.items()}
+            new_entries = {}
+            for event_type in self._offsets:
+                saved = self._saved_counts[event_type]
+                new_entries[event_type] = {
+                    'partitions': self._partitions[event_type][saved:],
+                    'offsets': self._offsets[event_type][saved:]
+                }
+            last_offsets = dict(self._last_offsets)
+
+        for event_type, arrays in new_entries.items():
+            for name, values in arrays.items():
+                with open(f"{filename}.{event_type}.{name}", 'ab') as f:
+                    # Drop anything written after the last complete checkpoint
+                    f.truncate(self._saved_counts[event_type] * values.itemsize)
+                    values.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        checkpoint = {
+            "num_buy_events": counts.get('buy', 0),
+            "num_sell_events": counts.get('sell', 0),
+            "counts": counts,
+            "offsets": {str(partition_id): offset for partition_id, offset in last_offsets.items()}
+        }
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+        self._saved_counts = counts
+
+    def load(self, filename):
+        """ Restores a checkpoint written by save(), returns False if there is none """
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'r') as f:
+            checkpoint = json.load(f)
+
+        with self._lock:
+            for event_type in self._offsets:
+                count = checkpoint["counts"].get(event_type, 0)
+                arrays = {'partitions': array('i'), 'offsets': array('q')}
+                for name, values in arrays.items():
+                    with open(f"{filename}.{event_type}.{name}", 'rb') as f:
+                        values.frombytes(f.read(count * values.itemsize))
+                    if len(values) != count:
+                        raise ValueError(f"Index file for {event_type} {name} is truncated")
+                self._partitions[event_type] = arrays['partitions']
+                self._offsets[event_type] = arrays['offsets']
+                self._saved_counts[event_type] = count
+            self._last_offsets = {int(partition_id): offset
+                                  for partition_id, offset in checkpoint["offsets"].items()}
+        return True
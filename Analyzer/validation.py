@@ -0,0 +1,231 @@
+"""
+Validation policy of the API request and response bodies
+
+Connexion builds a JSON schema validator for every request and response,
+and validating a response means buffering and parsing the whole body, so
+the cost grows with the size of the payload. Here the compiled validators
+are cached per schema, bodies are parsed with the codec, and responses
+are validated according to a policy:
+
+- full: every response is validated
+- sampled: 1 in sample_rate responses of each endpoint is validated
+- request_only: responses are not validated
+
+Request bodies are always validated. The policy can be set for single
+endpoints by operationId, and what it validated is counted for /validation.
+The validators of every schema of the spec are compiled by prebuild at
+startup, so the first request of an endpoint does not pay for it.
+"""
+
+import itertools
+from threading import Lock
+
+from connexion.datastructures import MediaTypeDict
+from connexion.exceptions import BadRequestProblem, NonConformingResponseBody
+from connexion.json_schema import Draft4RequestValidator, Draft4ResponseValidator
+from connexion.middleware.request_validation import RequestValidationMiddleware
+from connexion.middleware.response_validation import ResponseValidationMiddleware
+from connexion.utils import is_json_mimetype
+from connexion.validators import VALIDATOR_MAP as CONNEXION_VALIDATOR_MAP
+from connexion.validators import JSONRequestBodyValidator, JSONResponseBodyValidator
+from jsonschema import draft4_format_checker
+
+import codec
+
+POLICIES = ("full", "sampled", "request_only")
+
+# (validator class, id of the schema) -> (schema, compiled validator), the
+# schema is kept so its id cannot be reused by another one
+_COMPILED = {}
+_COMPILED_LOCK = Lock()
+
+
+def compiled(validator_cls, schema):
+    """ The validator of a schema, compiled on first use """
+    key = (validator_cls, id(schema))
+    entry = _COMPILED.get(key)
+    if entry is None:
+        with _COMPILED_LOCK:
+            entry = _COMPILED.get(key)
+            if entry is None:
+                entry = (schema, validator_cls(schema, format_checker=draft4_format_checker))
+                _COMPILED[key] = entry
+    return entry[1]
+
+
+def _request_schemas(operation):
+    """ The JSON request body schemas of a spec operation """
+    if not operation.request_body:
+        return []
+    return [operation.body_schema(mime_type) for mime_type in operation.consumes if is_json_mimetype(mime_type)]
+
+
+def _response_schemas(operation):
+    """ The JSON response body schemas of a spec operation """
+    return [operation.response_schema(status, mime_type)
+            for status in operation.responses
+            for mime_type in operation.produces if is_json_mimetype(mime_type)]
+
+
+def prebuild(app):
+    """
+    Builds connexion's middleware stack and compiles the validators of the
+    request and response schemas of every operation. Connexion refuses new
+    APIs and middlewares once the stack is built, so call it after adding
+    them. Returns the number of validators compiled.
+    """
+    middleware = app.middleware
+    if middleware.middleware_stack is None:
+        # What connexion does on the first request
+        middleware.app, middleware.middleware_stack = middleware._build_middleware_stack()
+    # The validation middlewares each load the spec, and pass the schemas
+    # of their own operations to the validators, so those are the ones
+    # compiled
+    validator_schemas = (
+        (RequestValidationMiddleware, Draft4RequestValidator, _request_schemas),
+        (ResponseValidationMiddleware, Draft4ResponseValidator, _response_schemas),
+    )
+    for layer in middleware.middleware_stack:
+        for middleware_cls, validator_cls, schemas in validator_schemas:
+            if not isinstance(layer, middleware_cls):
+                continue
+            for apis in layer.apis.values():
+                for api in apis:
+                    for operation in api.operations.values():
+                        for schema in schemas(operation._operation):
+                            if schema:
+                                compiled(validator_cls, schema)
+    return len(_COMPILED)
+
+
+class ValidationPolicy:
+    """ Decides which responses are validated and counts the outcomes per endpoint """
+
+    def __init__(self, config=None):
+        """
+        Args:
+            config (dict): 'responses' policy, 'sample_rate' and the
+                'endpoints' policies by operationId, all optional.
+        """
+        config = config or {}
+        self.responses = config.get("responses", "full")
+        self.sample_rate = max(1, config.get("sample_rate", 100))
+        self.endpoints = dict(config.get("endpoints") or {})
+        for policy in [self.responses, *self.endpoints.values()]:
+            if policy not in POLICIES:
+                raise ValueError(f"Unknown validation policy {policy}, expected one of {', '.join(POLICIES)}")
+        self._samples = {}
+        self._lock = Lock()
+        self._counts = {}
+
+    def policy(self, operation_id):
+        """ Policy of an endpoint """
+        return self.endpoints.get(operation_id, self.responses)
+
+    def should_validate(self, operation_id):
+        """ Whether to validate the current response of an endpoint """
+        policy = self.policy(operation_id)
+        if policy == "sampled":
+            samples = self._samples.get(operation_id)
+            if samples is None:
+                samples = self._samples.setdefault(operation_id, itertools.count())
+            return next(samples) % self.sample_rate == 0
+        return policy == "full"
+
+    def record(self, operation_id, outcome):
+        """ Counts a validated, skipped or failed response of an endpoint """
+        with self._lock:
+            counts = self._counts.get(operation_id)
+            if counts is None:
+                counts = self._counts[operation_id] = {"validated": 0, "skipped": 0, "failed": 0}
+            counts[outcome] += 1
+
+    def stats(self):
+        """ The policy and the responses counted of each endpoint """
+        with self._lock:
+            counts = {operation_id: dict(values) for operation_id, values in self._counts.items()}
+        return {
+            "responses": self.responses,
+            "sample_rate": self.sample_rate,
+            "compiled_validators": len(_COMPILED),
+            "endpoints": [
+                {"operation_id": operation_id, "policy": self.policy(operation_id), **counts[operation_id]}
+                for operation_id in sorted(counts)
+            ]
+        }
+
+
+POLICY = ValidationPolicy()
+
+
+def configure(config):
+    """ Sets the validation policy from the 'validation' section of app_conf.yml """
+    global POLICY
+    POLICY = ValidationPolicy(config)
+
+
+class CachedJSONRequestBodyValidator(JSONRequestBodyValidator):
+    """ JSON request body validator with a cached compiled schema """
+
+    @property
+    def _validator(self):
+        return compiled(Draft4RequestValidator, self._schema)
+
+    async def _parse(self, stream, scope):
+        body = b"".join([message async for message in stream])
+        if not body:
+            return None
+        try:
+            return codec.loads(body)
+        except ValueError as e:
+            raise BadRequestProblem(detail=str(e))
+
+
+class PolicyJSONResponseBodyValidator(JSONResponseBodyValidator):
+    """ JSON response body validator with a cached compiled schema, which
+    lets the responses the policy skips through without buffering them """
+
+    @property
+    def validator(self):
+        return compiled(Draft4ResponseValidator, self._schema)
+
+    def wrap_send(self, send):
+        routing = self._scope.get("extensions", {}).get("connexion_routing", {})
+        self._operation_id = routing.get("operation_id")
+        if not POLICY.should_validate(self._operation_id):
+            POLICY.record(self._operation_id, "skipped")
+            return send
+        return super().wrap_send(send)
+
+    def _parse(self, stream):
+        body = b"".join(stream)
+        if not body:
+            return None
+        try:
+            return codec.loads(body)
+        except ValueError as e:
+            raise NonConformingResponseBody(str(e))
+
+    def _validate(self, body):
+        try:
+            super()._validate(body)
+        except NonConformingResponseBody:
+            POLICY.record(self._operation_id, "failed")
+            raise
+        POLICY.record(self._operation_id, "validated")
+
+
+BODY_VALIDATORS = MediaTypeDict({
+    **CONNEXION_VALIDATOR_MAP["body"],
+    "*/*json": CachedJSONRequestBodyValidator
+})
+
+RESPONSE_VALIDATORS = MediaTypeDict({
+    **CONNEXION_VALIDATOR_MAP["response"],
+    "*/*json": PolicyJSONResponseBodyValidator
+})
+
+VALIDATOR_MAP = {
+    "body": BODY_VALIDATORS,
+    "response": RESPONSE_VALIDATORS
+}
@@ -10,7 +10,19 @@ import datetime
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 import os
-import json
+import time
+import codec
+import validation
+from conditional import Snapshot
+from stats_store import StatsStore
+from rollups import GRANULARITIES, Rollups
+from broadcaster import Broadcaster, SSEMiddleware
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -37,71 +49,258 @@ logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 
-def get_stats():
-    logger.info(f'Get stats request has started')
-    datastore = app_config['datastore']['filename']
-    try: 
-        with open(datastore, 'r') as file:
-            data = json.load(file)
-    except FileNotFoundError: 
-        logger.error(f'Statistics do not exis')
-        return {"message": "Statistics do not exist"}, 404
-    response_data = {
+DEFAULT_STATS = {
+    'num_buy_events': 0,
+    'max_buy_price': 0,
+    'num_sell_events': 0,
+    'max_sell_price': 0,
+    'last_updated': '2024-10-03T11:03:00'
+    }
+STREAM_STATS = None
+STATS_LOCK = Lock()
+
+# Settings missing from configs of older versions take the defaults of app_conf.yml
+MODE = app_config.get('mode', 'poll')
+datastore_config = app_config['datastore']
+eventstore_config = app_config['eventstore']
+stream_config = app_config.get('stream', {})
+rollups_config = {'enabled': True, 'minute': 1440, 'hour': 2160, 'day': 730, 'max_genres': 16,
+                  **app_config.get('rollups', {})}
+if 'legacy_filename' in datastore_config:
+    stats_filename = datastore_config['filename']
+    legacy_filename = datastore_config['legacy_filename']
+else:
+    # Configs from before the SQLite datastore name the JSON file datastore
+    legacy_filename = datastore_config['filename']
+    stats_filename = os.path.join(os.path.dirname(legacy_filename), 'stats.sqlite')
+    logger.warning(f"No legacy_filename configured, importing {legacy_filename} into {stats_filename}")
+
+STATS_STORE = StatsStore(stats_filename,
+                         datastore_config.get('synchronous', 'NORMAL'),
+                         history_retention=datetime.timedelta(days=datastore_config.get('history_retention', 30)))
+# Stats kept by the JSON file datastore of earlier versions carry over
+STATS_STORE.import_legacy(legacy_filename)
+
+# Minute, hour and day rollups of the events, for /stats/series
+if rollups_config['enabled']:
+    ROLLUPS = Rollups({granularity: rollups_config[granularity] for granularity in GRANULARITIES},
+                      rollups_config['max_genres'])
+    ROLLUPS.load(STATS_STORE.load_rollups())
+else:
+    ROLLUPS = None
+
+def load_stats():
+    """ Reads the stats from the datastore, or the defaults if there are none """
+    stored = STATS_STORE.load()
+    return stored if stored is not None else dict(DEFAULT_STATS)
+
+def save_stats(data, window=None):
+    """ Writes the stats, the window of events they were updated from and
+    the rollups that changed to the datastore """
+    if window is not None and not (window['num_buy_events'] or window['num_sell_events']):
+        # A window without events adds nothing to the history
+        window = None
+    STATS_STORE.save(data, window, ROLLUPS.dump() if ROLLUPS is not None else None)
+
+def empty_window(start_timestamp):
+    """ Stats of a window of events with no events yet """
+    return {
+        'start_timestamp': start_timestamp,
+        'end_timestamp': start_timestamp,
+        'num_buy_events': 0,
+        'max_buy_price': None,
+        'num_sell_events': 0,
+        'max_sell_price': None
+        }
+
+def stats_response(data):
+    """ The stats served by get_stats """
+    return {
         'num_buy_events': data['num_buy_events'],
         'max_buy_price': data['max_buy_price'],
         'num_sell_events': data['num_sell_events'],
         'max_sell_price': data['max_sell_price'],
         'last_updated': data['last_updated']
         }
-    
+
+# The stats get_stats serves, kept in memory so polls do not read the
+# datastore, and versioned for conditional GETs
+STATS_SNAPSHOT = Snapshot()
+if STATS_STORE.load() is not None:
+    STATS_SNAPSHOT.update(stats_response(load_stats()))
+
+# Pushes the stats to the clients of /stats/stream, the whole stats when
+# they connect, then the fields that changed
+STATS_BROADCASTER = Broadcaster(lambda: [("stats", STATS_SNAPSHOT.value)] if STATS_SNAPSHOT.value else [],
+                                stream_config.get('queue_size', 100),
+                                stream_config.get('keepalive_sec', 15))
+PUSHED_STATS = {}
+
+def push_stats(stats):
+    """ Pushes the stats fields that changed since the last push """
+    global PUSHED_STATS
+    delta = {key: value for key, value in stats.items() if PUSHED_STATS.get(key) != value}
+    if delta:
+        STATS_BROADCASTER.publish("stats", delta)
+        PUSHED_STATS = stats
+
+def get_stats():
+    logger.info(f'Get stats request has started')
+    if STREAM_STATS is not None:
+        with STATS_LOCK:
+            STATS_SNAPSHOT.update(stats_response(STREAM_STATS))
+    elif STATS_SNAPSHOT.value is None:
+        logger.error(f'Statistics do not exis')
+        return {"message": "Statistics do not exist"}, 404
+
+    response_data, headers = STATS_SNAPSHOT.read(connexion.request.headers)
+    if response_data is None:
+        logger.info(f'Get stats request has completed, not modified')
+        return NoContent, 304, headers
+
     logger.debug(f"Statistics response: {response_data}")
     logger.info(f'Get stats request has completed')
 
-    return response_data, 200
+    return response_data, 200, headers
+
+def get_stats_history(start_timestamp=None, end_timestamp=None, limit=100):
+    """ Gets the windows of events the stats were updated from, newest first """
+    logger.info(f'Get stats history request has started')
+    windows = STATS_STORE.history(start_timestamp, end_timestamp, limit)
+    logger.info(f'Get stats history request has completed, {len(windows)} windows')
+    return windows, 200
+
+def get_stats_series(granularity, start, end):
+    """ Gets the rollups of the buy and sell events from start to end, one bucket per granularity """
+    logger.info(f'Get stats series request has started')
+    if ROLLUPS is None:
+        return {"message": "Rollups are disabled"}, 404
+    try:
+        buckets = ROLLUPS.query(granularity, start, end)
+    except ValueError:
+        return {"message": "start and end must be timestamps like 2024-10-31T09:49:14"}, 400
+    if start > end:
+        return {"message": "start must not be after end"}, 400
+    logger.info(f'Get stats series request has completed, {len(buckets)} buckets')
+    return {'granularity': granularity, 'buckets': buckets}, 200
+
+# Pooled connections to Storage. Failed connections and 502/503/504
+# responses of its GETs, which are idempotent, are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(max_retries=Retry(total=eventstore_config.get('retries', 3),
+                                                       backoff_factor=0.5,
+                                                       status_forcelist=(502, 503, 504),
+                                                       allowed_methods=('GET',))))
+TIMEOUT = eventstore_config.get('timeout', 10)
+# Fetches the buy and sell events of a window at the same time
+FETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fetch')
+
+def iter_events(event_type, start_timestamp, end_timestamp):
+    """ Yields the events of a type in a time window from Storage, one page at a time """
+    app_url = eventstore_config['url']
+    page_size = eventstore_config.get('page_size', 1000)
+    after_id = 0
+    while True:
+        url = (f'{app_url}/books/{event_type}?start_timestamp={start_timestamp}'
+               f'&end_timestamp={end_timestamp}&after_id={after_id}&limit={page_size}')
+        response = SESSION.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        page = codec.loads(response.content)
+        yield from page
+        if len(page) < page_size:
+            return
+        after_id = page[-1]['id']
+
+def page_window_stats(event_type, start_timestamp, end_timestamp):
+    """ Count and max price of the events of a type in a time window, with
+    the (timestamp, price, genre) of each event for the rollups """
+    count = 0
+    max_price = None
+    events = []
+    for event in iter_events(event_type, start_timestamp, end_timestamp):
+        count += 1
+        max_price = event['price'] if max_price is None else max(max_price, event['price'])
+        if ROLLUPS is not None:
+            events.append((event['date_created'], event['price'], event.get('genre')))
+    return {'count': count, 'max_price': max_price, 'events': events}
+
+def minute_window_stats(buckets):
+    """ Count and max price of the events of a type in a time window, from
+    its minute aggregates, with the aggregates for the rollups """
+    return {
+        'count': sum(bucket['count'] for bucket in buckets),
+        'max_price': max((bucket['max_price'] for bucket in buckets), default=None),
+        'buckets': buckets
+    }
+
+def fetch_window_stats(start_timestamp, end_timestamp):
+    """ Count and max price of the buy and sell events in a time window, or None if Storage failed """
+    app_url = eventstore_config['url']
+    # The rollups need the events by minute, the stats only their totals
+    endpoint = 'stats/window' if ROLLUPS is None else 'stats/window/minutes'
+    window_url = f'{app_url}/{endpoint}?start_timestamp={start_timestamp}&end_timestamp={end_timestamp}'
+    response = SESSION.get(window_url, timeout=TIMEOUT)
+
+    if response.status_code == 200:
+        fetched = codec.loads(response.content)
+        if ROLLUPS is None:
+            return fetched
+        return {event_type: minute_window_stats(fetched[event_type]) for event_type in ('buy', 'sell')}
+    elif response.status_code == 404:
+        # Storage without the aggregate endpoint, page through the events instead
+        logger.warning(f"Window stats are not available, paging through events")
+    else:
+        logger.error(f"Failed to get window stats. Status code: {response.status_code}")
+        return None
+
+    buy = FETCH_POOL.submit(page_window_stats, 'buy', start_timestamp, end_timestamp)
+    sell = FETCH_POOL.submit(page_window_stats, 'sell', start_timestamp, end_timestamp)
+    return {'buy': buy.result(), 'sell': sell.result()}
+
+def sub_windows(start_timestamp, end_timestamp, window_sec):
+    """ Splits a time window into consecutive windows of at most window_sec seconds """
+    start = datetime.datetime.strptime(start_timestamp, '%Y-%m-%dT%H:%M:%S')
+    end = datetime.datetime.strptime(end_timestamp, '%Y-%m-%dT%H:%M:%S')
+    step = datetime.timedelta(seconds=window_sec)
+    while start < end:
+        window_end = min(start + step, end)
+        yield start.strftime('%Y-%m-%dT%H:%M:%S'), window_end.strftime('%Y-%m-%dT%H:%M:%S')
+        start = window_end
 
 def populate_stats():
     """ Periodically update stats """
 
     logger.info(f'Periodic processing has started')
 
-    data_store = app_config['datastore']['filename']
-    if os.path.exists(data_store):
-        with open(data_store, 'r') as file:
-                data = json.load(file)
-    else: 
-        data = {
-        'num_buy_events': 0,
-        'max_buy_price': 0,
-        'num_sell_events': 0,
-        'max_sell_price': 0,
-        'last_updated': '2024-10-03T11:03:00'
-        }
+    data = load_stats()
 
     current_timestamp = datetime.datetime.now()
     current_datetime_str = current_timestamp.strftime('%Y-%m-%dT%H:%M:%S')
-    start_timestamp = data['last_updated']
-    end_timestamp = current_datetime_str
-
 
-    app_url = app_config['eventstore']['url']
-    buy_url = f'{app_url}/books/buy?start_timestamp={start_timestamp}&end_timestamp={end_timestamp}'
-    response = requests.get(buy_url)
+    # After an outage the gap since the last update is caught up one bounded
+    # window at a time, each saved as it is done, so the time and memory a
+    # window takes do not grow with the outage and a failure resumes from
+    # the last window saved
+    windows = list(sub_windows(data['last_updated'], current_datetime_str, app_config.get('catchup', {}).get('window_sec', 300)))
+    if len(windows) > 1:
+        logger.info(f'Catching up from {data["last_updated"]} in {len(windows)} windows')
+    for start_timestamp, end_timestamp in windows:
+        try:
+            fetched = fetch_window_stats(start_timestamp, end_timestamp)
+        except requests.RequestException as e:
+            logger.error(f"Failed to get the events from {start_timestamp} to {end_timestamp}: {e}")
+            return
+        if fetched is None:
+            return
+        update_window_stats(data, start_timestamp, end_timestamp, fetched)
 
-    if response.status_code == 200:
-        result_list = response.json()
-        num_buy_events = len(result_list)
-        max_buy_price = max(result['price'] for result in result_list) if result_list else data['max_buy_price']
-    else:
-        logger.error(f"Failed to get buy events. Status code: {response.status_code}")
+def update_window_stats(data, start_timestamp, end_timestamp, fetched):
+    """ Adds the events fetched for a window to the stats and the rollups, and saves them """
 
-    sell_url = f'{app_url}/books/sell?start_timestamp={start_timestamp}&end_timestamp={end_timestamp}'
-    response = requests.get(sell_url)
-    if response.status_code == 200:
-        result_list = response.json()
-        num_sell_events = len(result_list)
-        max_sell_price = max(result['price'] for result in result_list) if result_list else data['max_sell_price']
-    else:
-        logger.error(f"Failed to get sell events. Status code: {response.status_code}")
+    num_buy_events = fetched['buy']['count']
+    max_buy_price = max(data['max_buy_price'], fetched['buy']['max_price']) if num_buy_events else data['max_buy_price']
+    num_sell_events = fetched['sell']['count']
+    max_sell_price = max(data['max_sell_price'], fetched['sell']['max_price']) if num_sell_events else data['max_sell_price']
 
     num_of_events = num_buy_events + num_sell_events
     logger.info(f'Total {num_of_events} events received')
@@ -111,25 +310,140 @@ def populate_stats():
     data['max_buy_price'] = max_buy_price
     data['num_sell_events'] += num_sell_events
     data['max_sell_price'] = max_sell_price
-    data['last_updated'] = current_datetime_str
+    data['last_updated'] = end_timestamp
 
-    with open(data_store, 'w') as file:
-        json.dump(data, file)
+    if ROLLUPS is not None:
+        for event_type in ('buy', 'sell'):
+            if 'buckets' in fetched[event_type]:
+                ROLLUPS.add_buckets(event_type, fetched[event_type]['buckets'])
+            else:
+                ROLLUPS.add_many(event_type, fetched[event_type]['events'])
+
+    window = {
+        'start_timestamp': start_timestamp,
+        'end_timestamp': end_timestamp,
+        'num_buy_events': num_buy_events,
+        'max_buy_price': fetched['buy']['max_price'] if num_buy_events else None,
+        'num_sell_events': num_sell_events,
+        'max_sell_price': fetched['sell']['max_price'] if num_sell_events else None
+        }
+    save_stats(data, window)
+    stats = stats_response(data)
+    STATS_SNAPSHOT.update(stats)
+    push_stats(stats)
     
     logger.debug(f"Updated stats: {data}")
 
+def update_stats(data, event):
+    """ Updates running stats with a single event """
+    event_type = event['type']
+    price = event['payload']['price']
+    if event_type == 'buy':
+        data['num_buy_events'] += 1
+        data['max_buy_price'] = max(data['max_buy_price'], price)
+    elif event_type == 'sell':
+        data['num_sell_events'] += 1
+        data['max_sell_price'] = max(data['max_sell_price'], price)
+    else:
+        logger.warning(f"Unknown event type: {event_type}")
+        return
+    data['last_updated'] = event['datetime']
+
+def update_window(window, event):
+    """ Updates the stats of a window with a single event """
+    event_type = event['type']
+    if event_type not in ('buy', 'sell'):
+        return
+    price = event['payload']['price']
+    max_price = window[f'max_{event_type}_price']
+    window[f'num_{event_type}_events'] += 1
+    window[f'max_{event_type}_price'] = price if max_price is None else max(max_price, price)
+    window['end_timestamp'] = event['datetime']
+
+def stream_stats():
+    """ Updates stats from every event in the events topic as it arrives """
+    global STREAM_STATS
+    checkpoint_interval = app_config.get('checkpoint', {}).get('interval_sec', 5)
+    resuming = STATS_STORE.load() is not None
+    with STATS_LOCK:
+        STREAM_STATS = load_stats()
+    window = empty_window(STREAM_STATS['last_updated'])
+
+    hostname = "%s:%d" % (app_config["events"]["hostname"],
+                          app_config["events"]["port"])
+    client = KafkaClient(hosts=hostname)
+    topic = client.topics[str.encode(app_config["events"]["topic"])]
+    # Without a committed offset, start from the beginning of the topic
+    # for fresh stats, or from new messages if the stats already count
+    # the history. The consumer timeout wakes the loop up so checkpoints
+    # are also written when no new messages arrive.
+    consumer = topic.get_simple_consumer(
+        consumer_group=str.encode(app_config["events"].get("consumer_group", "processing_group")),
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.LATEST if resuming else OffsetType.EARLIEST,
+        consumer_timeout_ms=checkpoint_interval * 1000)
+    logger.info(f'Streaming stats from topic {app_config["events"]["topic"]}')
+
+    last_checkpoint = time.monotonic()
+    pending = 0
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            event = codec.decode_event(msg.value)
+            with STATS_LOCK:
+                update_stats(STREAM_STATS, event)
+            update_window(window, event)
+            if ROLLUPS is not None:
+                payload = event['payload']
+                ROLLUPS.add(event['type'], event['datetime'], payload['price'], payload.get('genre'))
+            pending += 1
+
+        if pending and time.monotonic() - last_checkpoint >= checkpoint_interval:
+            with STATS_LOCK:
+                data = dict(STREAM_STATS)
+            # Offsets are committed after the stats are written, so a crash
+            # in between replays events rather than losing them
+            save_stats(data, window)
+            consumer.commit_offsets()
+            logger.info(f'Checkpointed stats after {pending} events')
+            logger.debug(f"Updated stats: {data}")
+            last_checkpoint = time.monotonic()
+            pending = 0
+            window = empty_window(data['last_updated'])
+
 
     
 
+def push_stream_stats():
+    """ Pushes the changes of the streamed stats, batching the events of a push interval """
+    if STREAM_STATS is None:
+        return
+    with STATS_LOCK:
+        stats = stats_response(STREAM_STATS)
+    STATS_SNAPSHOT.update(stats)
+    push_stats(stats)
+
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats,
-                  'interval',
-                   seconds=app_config['scheduler']['period_sec'])
+    if MODE == 'stream':
+        sched.add_job(push_stream_stats,
+                      'interval',
+                       seconds=stream_config.get('push_interval_sec', 1))
+    else:
+        sched.add_job(populate_stats,
+                      'interval',
+                       seconds=app_config['scheduler']['period_sec'])
     sched.start()
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/processing", strict_validation=True, validate_responses=True)
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+validation.configure(app_config.get('validation'))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/processing", strict_validation=True, validate_responses=True,
+            validator_map=validation.VALIDATOR_MAP)
 app.add_middleware(
     CORSMiddleware,
     position=MiddlewarePosition.BEFORE_EXCEPTION,
@@ -138,12 +452,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    SSEMiddleware,
+    position=MiddlewarePosition.BEFORE_ROUTING,
+    path="/processing/stats/stream",
+    broadcaster=STATS_BROADCASTER,
+)
 
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
     
 if __name__ == "__main__":
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
     # run our standalone gevent server
+    if MODE == 'stream':
+        t1 = Thread(target=stream_stats)
+        t1.setDaemon(True)
+        t1.start()
     init_scheduler()
     app.run(host="0.0.0.0",port=8100)
@@ -0,0 +1,116 @@
+"""
+Server-Sent Events broadcaster
+
+A Broadcaster fans the events the service's threads publish out to every
+client connected to its stream. Each client has a bounded queue on the
+server's event loop. A client that falls queue_size events behind is
+disconnected rather than sent a gap, and EventSource reconnects it to a
+fresh snapshot.
+
+SSEMiddleware serves a broadcaster at a path on the ASGI side of the
+app, so an open stream holds no WSGI worker thread of the Flask app.
+"""
+
+import asyncio
+import logging
+from threading import Lock
+
+from starlette.responses import StreamingResponse
+
+import codec
+
+logger = logging.getLogger('basicLogger')
+
+
+def encode(event, data, event_id=None):
+    """ A Server-Sent Event in wire format """
+    message = f"event: {event}\ndata: {codec.dumps_str(data)}\n\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+    return message.encode("utf-8")
+
+
+class Broadcaster:
+    """ Fans published events out to the connected clients of a stream """
+
+    def __init__(self, snapshot=None, queue_size=100, keepalive_sec=15):
+        """
+        Args:
+            snapshot (callable): Returns the (event, data) pairs sent to a
+                client when it connects, so it starts from the current state.
+            queue_size (int): Events a client can fall behind before it is
+                disconnected.
+            keepalive_sec (int): Idle time after which a comment is sent, so
+                proxies keep the connection open.
+        """
+        self.snapshot = snapshot
+        self.queue_size = queue_size
+        self.keepalive_sec = keepalive_sec
+        self._lock = Lock()
+        self._clients = set()
+        self._event_id = 0
+
+    def publish(self, event, data):
+        """ Sends an event to every client, callable from any thread """
+        with self._lock:
+            self._event_id += 1
+            message = encode(event, data, self._event_id)
+            clients = list(self._clients)
+        for loop, queue in clients:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, message)
+            except RuntimeError:
+                # The server's event loop closed while shutting down
+                pass
+
+    def _put(self, queue, message):
+        """ Queues a message for a client, on the client's event loop """
+        if queue.full():
+            # Too far behind to catch up, end the stream instead of skipping events
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+            return
+        queue.put_nowait(message)
+
+    async def stream(self):
+        """ Yields the snapshot, then the published events, of a client's stream """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        client = (asyncio.get_running_loop(), queue)
+        # Registered before the snapshot is taken, so no event falls in between
+        with self._lock:
+            self._clients.add(client)
+        try:
+            for event, data in (self.snapshot() if self.snapshot else []):
+                yield encode(event, data)
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.keepalive_sec)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    logger.warning("Disconnected a stream client that fell behind")
+                    return
+                yield message
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+
+
+class SSEMiddleware:
+    """ ASGI middleware serving the stream of a broadcaster at a path """
+
+    def __init__(self, app, path, broadcaster):
+        self.app = app
+        self.path = path
+        self.broadcaster = broadcaster
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        response = StreamingResponse(self.broadcaster.stream(),
+                                     media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        await response(scope, receive, send)
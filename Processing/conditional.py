@@ -0,0 +1,88 @@
+"""
+Conditional GETs of in-memory state
+
+State served to pollers, like the dashboard, carries a version counter
+bumped on every change. Responses send it as the ETag, with the time of
+the change as Last-Modified, and a request whose If-None-Match (or, if it
+has none, If-Modified-Since) matches the current version is answered with
+an empty 304. Browsers revalidate responses marked no-cache on every poll,
+so an unchanged poll costs a header exchange instead of a body.
+"""
+
+import datetime
+import uuid
+from email.utils import format_datetime, parsedate_to_datetime
+from threading import RLock
+
+# Part of every ETag, so versions counted by a restarted process never
+# match the ETags a client kept from the previous one
+INSTANCE = uuid.uuid4().hex[:8]
+
+
+class Version:
+    """ Version counter and modification time of a piece of state """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.number = 0
+        self.modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    def bump(self):
+        """ Records a change of the state """
+        with self._lock:
+            self.number += 1
+            self.modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    @property
+    def etag(self):
+        return f'"{INSTANCE}-{self.number}"'
+
+    def headers(self):
+        """ Validator headers of a response of the current version """
+        return {
+            "ETag": self.etag,
+            "Last-Modified": format_datetime(self.modified, usegmt=True),
+            "Cache-Control": "no-cache"
+        }
+
+    def check(self, request_headers):
+        """ Whether the client already has the current version, and the
+        headers of that version. Take them before building the body, so a
+        body is never older than its ETag """
+        with self._lock:
+            return self._not_modified(request_headers), self.headers()
+
+    def _not_modified(self, request_headers):
+        if_none_match = request_headers.get("If-None-Match")
+        if if_none_match is not None:
+            etags = {etag.strip() for etag in if_none_match.split(",")}
+            return "*" in etags or self.etag in etags or f"W/{self.etag}" in etags
+        if_modified_since = request_headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                return self.modified <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class Snapshot(Version):
+    """ Latest value of a piece of state, versioned when it changes """
+
+    def __init__(self, value=None):
+        super().__init__()
+        self.value = value
+
+    def update(self, value):
+        """ Replaces the value, bumping the version if it changed """
+        with self._lock:
+            if value != self.value:
+                self.value = value
+                self.bump()
+
+    def read(self, request_headers):
+        """ The value and the headers of the current version, the value is
+        None if the client already has it """
+        with self._lock:
+            not_modified, headers = self.check(request_headers)
+            return (None if not_modified else self.value), headers
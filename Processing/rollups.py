@@ -0,0 +1,288 @@
+"""
+Time bucketed rollups of the events
+
+Every event is counted in a minute, an hour and a day bucket of its type,
+with the sum, min and max of the prices, and for sells the count of each
+genre. Events can also be added already aggregated by minute, as Storage
+does for a window of events. A series of buckets is a ring of typed arrays, one slot per bucket,
+holding the last `size` buckets of its granularity, so memory is fixed
+and a bucket is found by index: a range query costs a constant time per
+bucket, whatever the number of events.
+
+Each slot records the bucket it holds, so a slot left over from a previous
+turn of the ring reads as empty. The buckets that changed since the last
+save are saved to the stats datastore as one row each, in the same
+transaction as the stats, so a save costs the buckets that changed and not
+the size of the rings.
+"""
+
+import datetime
+from array import array
+from threading import Lock
+
+GRANULARITIES = {'minute': 60, 'hour': 3600, 'day': 86400}
+EVENT_TYPES = ('buy', 'sell')
+# Genres past max_genres are counted together, so free text genres cannot grow the arrays without bound
+OTHER_GENRE = 'Other'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def epoch_seconds(timestamp):
+    """ Seconds since the epoch of a timestamp string, with or without fractional seconds """
+    # fromisoformat is several times faster than strptime, which matters once per event
+    return int(datetime.datetime.fromisoformat(timestamp[:19]).replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def format_timestamp(seconds):
+    """ Timestamp string of seconds since the epoch """
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+class Series:
+    """ Ring of the last buckets of an event type at a granularity """
+
+    def __init__(self, seconds, size, max_genres=0):
+        """
+        Args:
+            seconds (int): Length of a bucket.
+            size (int): Number of buckets kept.
+            max_genres (int): Number of genres counted separately, 0 to not
+                count genres.
+        """
+        self.seconds = seconds
+        self.size = size
+        self.max_genres = max_genres
+        # Bucket number of each slot, -1 if the slot was never used
+        self.buckets = array('q', [-1]) * size
+        self.counts = array('q', [0]) * size
+        self.sums = array('d', [0.0]) * size
+        self.mins = array('d', [0.0]) * size
+        self.maxs = array('d', [0.0]) * size
+        self.genres = {}
+        self.newest = -1
+        # Slots changed since the last dump
+        self.dirty = set()
+        # Events older than the ring holds, e.g. replayed late
+        self.dropped = 0
+
+    def _slot(self, bucket):
+        """ The slot of a bucket, cleared if it holds an older one, or None
+        if the bucket is older than the ring holds, as its slot belongs to
+        a newer bucket """
+        if bucket <= self.newest - self.size:
+            return None
+        slot = bucket % self.size
+        if bucket > self.newest:
+            self.newest = bucket
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+            self.sums[slot] = 0.0
+            for counts in self.genres.values():
+                counts[slot] = 0
+        return slot
+
+    def add(self, seconds, price, genre=None):
+        """ Counts an event at a time in seconds since the epoch """
+        bucket = seconds // self.seconds
+        slot = self._slot(bucket)
+        if slot is None:
+            self.dropped += 1
+            return
+        if self.counts[slot] == 0:
+            self.mins[slot] = price
+            self.maxs[slot] = price
+        else:
+            self.mins[slot] = min(self.mins[slot], price)
+            self.maxs[slot] = max(self.maxs[slot], price)
+        self.counts[slot] += 1
+        self.sums[slot] += price
+        self.dirty.add(slot)
+        if self.max_genres and genre is not None:
+            self._genre_counts(genre)[slot] += 1
+
+    def add_aggregate(self, seconds, count, sum_price, min_price, max_price, genres=None):
+        """ Counts events already aggregated, at a time in seconds since the
+        epoch, with the count of each genre if given """
+        if not count:
+            return
+        bucket = seconds // self.seconds
+        slot = self._slot(bucket)
+        if slot is None:
+            self.dropped += count
+            return
+        if self.counts[slot] == 0:
+            self.mins[slot] = min_price
+            self.maxs[slot] = max_price
+        else:
+            self.mins[slot] = min(self.mins[slot], min_price)
+            self.maxs[slot] = max(self.maxs[slot], max_price)
+        self.counts[slot] += count
+        self.sums[slot] += sum_price
+        self.dirty.add(slot)
+        if self.max_genres and genres:
+            for genre, genre_count in genres.items():
+                self._genre_counts(genre)[slot] += genre_count
+
+    def _genre_counts(self, genre):
+        counts = self.genres.get(genre)
+        if counts is None:
+            if len(self.genres) >= self.max_genres:
+                genre = OTHER_GENRE
+                counts = self.genres.get(genre)
+            if counts is None:
+                counts = self.genres[genre] = array('q', [0]) * self.size
+        return counts
+
+    def get(self, bucket):
+        """ The stats of a bucket, empty if it is not in the ring """
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket or self.counts[slot] == 0:
+            stats = {'count': 0, 'sum_price': 0.0, 'min_price': None, 'max_price': None}
+            if self.max_genres:
+                stats['genres'] = {}
+            return stats
+        stats = {
+            'count': self.counts[slot],
+            'sum_price': self.sums[slot],
+            'min_price': self.mins[slot],
+            'max_price': self.maxs[slot]
+        }
+        if self.max_genres:
+            stats['genres'] = {genre: counts[slot] for genre, counts in self.genres.items() if counts[slot]}
+        return stats
+
+    def oldest(self):
+        """ The oldest bucket the ring holds """
+        return self.newest - self.size + 1
+
+    def dump(self):
+        """ (bucket, count, sum_price, min_price, max_price, genres) of the
+        buckets that changed since the last dump, genres a dict of the
+        genre counts, or None if genres are not counted """
+        rows = []
+        for slot in sorted(self.dirty):
+            genres = None
+            if self.max_genres:
+                genres = {genre: counts[slot] for genre, counts in self.genres.items() if counts[slot]}
+            rows.append((self.buckets[slot], self.counts[slot], self.sums[slot],
+                         self.mins[slot], self.maxs[slot], genres))
+        self.dirty.clear()
+        return rows
+
+    def load(self, rows):
+        """ Restores dumped buckets, leaving out those older than the ring
+        holds, e.g. after its size was reduced """
+        if not rows:
+            return
+        oldest = max(row[0] for row in rows) - self.size + 1
+        for bucket, count, sum_price, min_price, max_price, genres in sorted(rows, key=lambda row: row[0]):
+            if bucket < oldest:
+                continue
+            slot = self._slot(bucket)
+            self.counts[slot] = count
+            self.sums[slot] = sum_price
+            self.mins[slot] = min_price
+            self.maxs[slot] = max_price
+            if self.max_genres and genres:
+                for genre, genre_count in genres.items():
+                    self._genre_counts(genre)[slot] += genre_count
+
+
+class Rollups:
+    """ Minute, hour and day series of the buy and sell events """
+
+    def __init__(self, retention, max_genres=32):
+        """
+        Args:
+            retention (dict): Number of buckets kept by granularity, e.g.
+                {'minute': 1440, 'hour': 720, 'day': 365}.
+            max_genres (int): Number of sell genres counted separately.
+        """
+        self._lock = Lock()
+        self._series = {
+            (granularity, event_type): Series(GRANULARITIES[granularity], retention[granularity],
+                                              max_genres if event_type == 'sell' else 0)
+            for granularity in GRANULARITIES
+            for event_type in EVENT_TYPES
+        }
+
+    def add(self, event_type, timestamp, price, genre=None):
+        """ Counts an event in the buckets of every granularity """
+        self.add_many(event_type, [(timestamp, price, genre)])
+
+    def add_many(self, event_type, events):
+        """ Counts (timestamp, price, genre) events of a type """
+        if event_type not in EVENT_TYPES:
+            return
+        events = [(epoch_seconds(timestamp), price, genre) for timestamp, price, genre in events]
+        series = [self._series[(granularity, event_type)] for granularity in GRANULARITIES]
+        with self._lock:
+            for seconds, price, genre in events:
+                for ring in series:
+                    ring.add(seconds, price, genre)
+
+    def add_buckets(self, event_type, buckets):
+        """ Counts the events of a type aggregated by minute, as dicts with
+        the start timestamp, count, sum_price, min_price, max_price and
+        genres counts of the minute """
+        if event_type not in EVENT_TYPES:
+            return
+        series = [self._series[(granularity, event_type)] for granularity in GRANULARITIES]
+        with self._lock:
+            for bucket in buckets:
+                seconds = epoch_seconds(bucket['start'])
+                for ring in series:
+                    ring.add_aggregate(seconds, bucket['count'], bucket['sum_price'],
+                                       bucket['min_price'], bucket['max_price'], bucket.get('genres'))
+
+    def query(self, granularity, start_timestamp, end_timestamp):
+        """
+        Returns the buckets of a granularity from the one holding the start
+        timestamp to the one holding the end timestamp, oldest first. A
+        range longer than the ring starts at its oldest bucket.
+        """
+        seconds = GRANULARITIES[granularity]
+        first = epoch_seconds(start_timestamp) // seconds
+        last = epoch_seconds(end_timestamp) // seconds
+        buy = self._series[(granularity, 'buy')]
+        sell = self._series[(granularity, 'sell')]
+        first = max(first, last - buy.size + 1)
+        with self._lock:
+            return [
+                {
+                    'start': format_timestamp(bucket * seconds),
+                    'buy': buy.get(bucket),
+                    'sell': sell.get(bucket)
+                }
+                for bucket in range(first, last + 1)
+            ]
+
+    def dump(self):
+        """
+        Returns the rollups changed since the last dump, as the
+        (granularity, event_type, bucket, count, sum_price, min_price,
+        max_price, genres) rows of the buckets that changed, and the
+        (granularity, event_type, bucket) of the oldest bucket each series
+        that changed holds, the older ones having left its ring.
+        """
+        buckets = []
+        oldest = []
+        with self._lock:
+            for (granularity, event_type), series in self._series.items():
+                if not series.dirty:
+                    continue
+                oldest.append((granularity, event_type, series.oldest()))
+                buckets += [(granularity, event_type, *row) for row in series.dump()]
+        return buckets, oldest
+
+    def load(self, rows):
+        """ Restores the series from dumped bucket rows """
+        series_rows = {}
+        for granularity, event_type, *row in rows:
+            series_rows.setdefault((granularity, event_type), []).append(row)
+        with self._lock:
+            for key, rows in series_rows.items():
+                series = self._series.get(key)
+                if series is not None:
+                    series.load(rows)
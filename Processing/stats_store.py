@@ -0,0 +1,198 @@
+"""
+SQLite datastore of the stats
+
+The current stats are one row, replaced in the same transaction that
+records the window of events they were updated from, so a crash leaves
+either the old stats or the new ones and never a partial file. The
+database is in WAL mode, so readers see the last committed stats while a
+write is in progress instead of waiting for it, and the recorded windows
+can be served as the stats history without querying Storage again. The
+history is kept for a retention period, windows that ended longer before
+the newest one are deleted as it is recorded. The rollup buckets that
+changed are saved with the stats they count the events of, one row each.
+
+The synchronous setting is the fsync policy: FULL fsyncs every commit,
+NORMAL only at WAL checkpoints, which can lose the last commits on a power
+failure but never corrupts the database.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import codec
+
+logger = logging.getLogger('basicLogger')
+
+STATS_FIELDS = ('num_buy_events', 'max_buy_price', 'num_sell_events', 'max_sell_price', 'last_updated')
+WINDOW_FIELDS = ('start_timestamp', 'end_timestamp', 'num_buy_events', 'max_buy_price',
+                 'num_sell_events', 'max_sell_price')
+ROLLUP_FIELDS = ('granularity', 'event_type', 'bucket', 'count', 'sum_price', 'min_price', 'max_price', 'genres')
+SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    num_buy_events INTEGER NOT NULL,
+    max_buy_price REAL NOT NULL,
+    num_sell_events INTEGER NOT NULL,
+    max_sell_price REAL NOT NULL,
+    last_updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats_windows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    start_timestamp TEXT NOT NULL,
+    end_timestamp TEXT NOT NULL,
+    num_buy_events INTEGER NOT NULL,
+    max_buy_price REAL,
+    num_sell_events INTEGER NOT NULL,
+    max_sell_price REAL
+);
+CREATE INDEX IF NOT EXISTS stats_windows_end ON stats_windows (end_timestamp);
+CREATE TABLE IF NOT EXISTS rollup_buckets (
+    granularity TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum_price REAL NOT NULL,
+    min_price REAL NOT NULL,
+    max_price REAL NOT NULL,
+    genres TEXT,
+    PRIMARY KEY (granularity, event_type, bucket)
+);
+"""
+
+
+class StatsStore:
+    """ Stats and the history of the windows they were updated from, in SQLite """
+
+    def __init__(self, filename, synchronous='NORMAL', busy_timeout_ms=5000, history_retention=None):
+        """
+        Creates the tables if they do not exist.
+
+        Args:
+            filename (str): Path of the SQLite database.
+            synchronous (str): fsync policy, OFF, NORMAL or FULL.
+            busy_timeout_ms (int): How long a write waits for another one.
+            history_retention (datetime.timedelta): How long the windows are
+                kept, None to keep them all.
+        """
+        if synchronous not in SYNCHRONOUS:
+            raise ValueError(f"Unknown synchronous setting {synchronous}, expected one of {', '.join(SYNCHRONOUS)}")
+        self.filename = filename
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.history_retention = history_retention
+        # One connection per thread, sqlite3 connections are not thread safe
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit, transactions are begun explicitly
+            connection = sqlite3.connect(self.filename, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f'PRAGMA synchronous={self.synchronous}')
+            connection.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+            self._local.connection = connection
+        return connection
+
+    def load(self):
+        """ The current stats, or None if none were saved """
+        row = self._connection().execute(
+            f"SELECT {', '.join(STATS_FIELDS)} FROM stats WHERE id = 1").fetchone()
+        return dict(row) if row is not None else None
+
+    def save(self, stats, window=None, rollups=None):
+        """
+        Replaces the stats and the rollups, and records the window the
+        stats were updated from, atomically. Windows past the retention are
+        deleted with it.
+
+        Args:
+            stats (dict): The stats, with every field of STATS_FIELDS.
+            window (dict): The stats of the window of events counted in, with
+                every field of WINDOW_FIELDS, the max prices None if the
+                window has no events of the type.
+            rollups (tuple): The rollup buckets that changed and the oldest
+                bucket of each series, as returned by Rollups.dump. Older
+                buckets of those series are deleted.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                f"INSERT OR REPLACE INTO stats (id, {', '.join(STATS_FIELDS)}) "
+                f"VALUES (1, {', '.join('?' * len(STATS_FIELDS))})",
+                [stats[field] for field in STATS_FIELDS])
+            if window is not None:
+                connection.execute(
+                    f"INSERT INTO stats_windows ({', '.join(WINDOW_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * len(WINDOW_FIELDS))})",
+                    [window[field] for field in WINDOW_FIELDS])
+                if self.history_retention is not None:
+                    cutoff = datetime.datetime.fromisoformat(window['end_timestamp'][:19]) - self.history_retention
+                    connection.execute("DELETE FROM stats_windows WHERE end_timestamp < ?",
+                                       [cutoff.strftime(TIMESTAMP_FORMAT)])
+            if rollups is not None:
+                buckets, oldest = rollups
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO rollup_buckets ({', '.join(ROLLUP_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * len(ROLLUP_FIELDS))})",
+                    [(*row[:-1], codec.dumps_str(row[-1]) if row[-1] is not None else None) for row in buckets])
+                connection.executemany(
+                    "DELETE FROM rollup_buckets WHERE granularity = ? AND event_type = ? AND bucket < ?",
+                    oldest)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def load_rollups(self):
+        """ (granularity, event_type, bucket, count, sum_price, min_price,
+        max_price, genres) rows of the saved rollup buckets """
+        rows = self._connection().execute(f"SELECT {', '.join(ROLLUP_FIELDS)} FROM rollup_buckets")
+        return [(*row[:-1], codec.loads(row[-1]) if row[-1] is not None else None) for row in rows]
+
+    def history(self, start_timestamp=None, end_timestamp=None, limit=100):
+        """
+        Returns the recorded windows that end in a time range, newest first.
+
+        Args:
+            start_timestamp (str): Only windows ending at or after it.
+            end_timestamp (str): Only windows ending at or before it.
+            limit (int): Maximum number of windows to return.
+        """
+        conditions = []
+        params = []
+        if start_timestamp is not None:
+            conditions.append('end_timestamp >= ?')
+            params.append(start_timestamp)
+        if end_timestamp is not None:
+            conditions.append('end_timestamp <= ?')
+            params.append(end_timestamp)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._connection().execute(
+            f"SELECT {', '.join(WINDOW_FIELDS)} FROM stats_windows {where} ORDER BY id DESC LIMIT ?",
+            [*params, limit])
+        return [dict(row) for row in rows]
+
+    def import_legacy(self, filename):
+        """ Imports the stats of the JSON file datastore, if there are no
+        stats yet. Returns whether stats were imported """
+        if self.load() is not None or not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, 'rb') as file:
+                stats = codec.loads(file.read())
+            self.save({field: stats[field] for field in STATS_FIELDS})
+        except (ValueError, KeyError) as e:
+            # A file truncated by a crash of the JSON datastore
+            logger.error(f"Could not import the stats of {filename}: {e}")
+            return False
+        logger.info(f"Imported the stats of {filename}")
+        return True
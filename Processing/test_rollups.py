@@ -0,0 +1,62 @@
+"""
+Regression tests of the rollups
+
+Run from the Processing directory with python -m unittest test_rollups
+"""
+
+import os
+import tempfile
+import unittest
+
+from rollups import Rollups, Series, format_timestamp
+from stats_store import StatsStore
+
+STATS = {'num_buy_events': 0, 'max_buy_price': 0, 'num_sell_events': 0, 'max_sell_price': 0,
+         'last_updated': '2024-10-01T12:00:00'}
+
+
+class LateBucketTest(unittest.TestCase):
+    """ A bucket older than the ring holds must not evict a newer one """
+
+    def test_add_drops_bucket_older_than_ring(self):
+        series = Series(60, 10)
+        series.add(100 * 60, 1.0)
+        series.add(95 * 60, 2.0)
+        series.add(90 * 60, 3.0)
+
+        self.assertEqual(series.get(100)['count'], 1)
+        self.assertEqual(series.get(95)['count'], 1)
+        self.assertEqual(series.get(90)['count'], 0)
+        self.assertEqual(series.dropped, 1)
+        self.assertEqual(sorted(row[0] for row in series.dump()), [95, 100])
+        self.assertEqual(series.oldest(), 91)
+
+    def test_add_aggregate_drops_bucket_older_than_ring(self):
+        series = Series(60, 10, max_genres=4)
+        series.add_aggregate(100 * 60, 2, 3.0, 1.0, 2.0, {'Fiction': 2})
+        series.add_aggregate(90 * 60, 5, 10.0, 1.0, 3.0, {'History': 5})
+
+        self.assertEqual(series.get(100), {'count': 2, 'sum_price': 3.0, 'min_price': 1.0,
+                                           'max_price': 2.0, 'genres': {'Fiction': 2}})
+        self.assertEqual(series.dropped, 5)
+
+    def test_saved_rollups_match_memory_after_late_event(self):
+        filename = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(lambda: [os.remove(filename + suffix) for suffix in ('', '-wal', '-shm')
+                                 if os.path.exists(filename + suffix)])
+        store = StatsStore(filename)
+        rollups = Rollups({'minute': 10, 'hour': 10, 'day': 10})
+        for minute in (100, 95, 90):
+            rollups.add('buy', format_timestamp(minute * 60), 1.0)
+        store.save(STATS, rollups=rollups.dump())
+
+        loaded = Rollups({'minute': 10, 'hour': 10, 'day': 10})
+        loaded.load(store.load_rollups())
+        start, end = format_timestamp(91 * 60), format_timestamp(100 * 60)
+        for granularity in ('minute', 'hour', 'day'):
+            self.assertEqual(loaded.query(granularity, start, end), rollups.query(granularity, start, end))
+        self.assertEqual(rollups.query('minute', start, end)[-1]['buy']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,22 @@
 import connexion
 from connexion import NoContent
-import json
-import datetime
 import os
 import requests
 import yaml
 import logging
 import logging.config
 import uuid
+from jsonschema import Draft4Validator, FormatChecker
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import AbstractRequestBodyValidator
 from pykafka import KafkaClient
+from event_producer import AsyncEventProducer, EventJournal, SyncEventProducer, StubEventProducer, QueueFullError
+import codec
+import validation
 
 EVENT_FILE = "event.json"
 MAX_EVENTS = 5
+SPEC_FILE = "BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml"
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -35,52 +40,205 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+# Settings missing from configs of older versions take the defaults of app_conf.yml
+MAX_BATCH_EVENTS = app_config.get('batch', {}).get('max_events', 1000)
+# Publish events in the compact binary format instead of JSON
+BINARY_EVENTS = app_config['events'].get('format', 'json') == 'binary'
+DEFAULT_JOURNAL = {'filename': 'events.journal', 'fsync': 'always', 'compact_bytes': 16777216}
+
+# Validators for the events of batch requests, built from the same
+# schemas connexion validates single events against
+with open(SPEC_FILE, 'r') as f:
+    schemas = yaml.safe_load(f.read())['components']['schemas']
+EVENT_VALIDATORS = {
+    'buy': Draft4Validator(schemas['buying'], format_checker=FormatChecker()),
+    'sell': Draft4Validator(schemas['selling'], format_checker=FormatChecker())
+}
+
 # Creating KafkaClient
 try:
-    server = app_config['events']['hostname']
-    port = app_config['events']['port']
-    client = KafkaClient(hosts=f'{server}:{port}')
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    producer = topic.get_sync_producer()
+    # Without a producer section, the async producer and journal of app_conf.yml
+    producer_config = app_config.get('producer', {'journal': DEFAULT_JOURNAL})
+    producer_mode = producer_config.get('mode', 'async')
+    if producer_mode == 'stub':
+        producer = StubEventProducer(producer_config.get('stub_latency_ms', 2))
+    else:
+        server = app_config['events']['hostname']
+        port = app_config['events']['port']
+        client = KafkaClient(hosts=f'{server}:{port}')
+        topic = client.topics[str.encode(app_config['events']['topic'])]
+        if producer_mode == 'async':
+            # Without a journal, async mode is at most once
+            journal_config = producer_config.get('journal')
+            if journal_config:
+                journal_config = {**DEFAULT_JOURNAL, **journal_config}
+                journal = EventJournal(journal_config['filename'],
+                                       journal_config['fsync'],
+                                       journal_config['compact_bytes'])
+            else:
+                journal = None
+            producer = AsyncEventProducer(topic,
+                                          producer_config.get('queue_size', 10000),
+                                          producer_config.get('batch_size', 500),
+                                          producer_config.get('linger_ms', 50),
+                                          producer_config.get('compression', 'none'),
+                                          journal)
+        else:
+            producer = SyncEventProducer(topic)
 except:
     logger.error(f'Unable to create connection with Kafka client.')
 
-    
-def book_buy(body):
+
+def encode_event(event_type, body):
+    """ Adds a trace id to a received event and encodes it for the events topic """
     trace_id = str(uuid.uuid4())
     body['trace_id'] = trace_id
-    logger.info(f'Received event buy request with a trace id of {trace_id}')
-    msg = { "type": "buy",
-            "datetime" :
-                datetime.datetime.now().strftime(
-                "%Y-%m-%dT%H:%M:%S"),
-                "payload": body }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    logger.info(f'Received event {event_type} request with a trace id of {trace_id}')
+    return trace_id, codec.encode_event(event_type, body, BINARY_EVENTS)
+
+def book_buy(body):
+    trace_id, message = encode_event("buy", body)
+    try:
+        producer.produce(message)
+    except QueueFullError:
+        logger.warning(f'Rejected event buy request (Id: {trace_id}), event queue is full')
+        return {"message": "Event queue is full"}, 503
     logger.info(f'Returned event buy response (Id: {trace_id}) with status 201')
     return NoContent, 201
 
 def book_sell(body):
-    trace_id = str(uuid.uuid4())
-    body['trace_id'] = trace_id
-    logger.info(f'Received event sell request with a trace id of {trace_id}')
-    msg = { "type": "sell",
-            "datetime" :
-                datetime.datetime.now().strftime(
-                "%Y-%m-%dT%H:%M:%S"),
-                "payload": body }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    trace_id, message = encode_event("sell", body)
+    try:
+        producer.produce(message)
+    except QueueFullError:
+        logger.warning(f'Rejected event sell request (Id: {trace_id}), event queue is full')
+        return {"message": "Event queue is full"}, 503
     logger.info(f'Returned event sell response (Id: {trace_id}) with status 201')
     return NoContent, 201
 
+def iter_lines(body):
+    """ Yields the lines of a bytes or str body, one at a time """
+    newline = b'\n' if isinstance(body, bytes) else '\n'
+    start = 0
+    while start < len(body):
+        end = body.find(newline, start)
+        if end == -1:
+            end = len(body)
+        yield body[start:end]
+        start = end + 1
+
+def parse_batch(body, max_events):
+    """ Returns the events of a JSON array or NDJSON request body,
+    NDJSON lines that are not valid JSON are returned as None. Raises
+    ValueError if the body is neither, is not valid UTF-8 or has more than
+    max_events events; an NDJSON body is parsed no further than the event
+    past the limit """
+    if isinstance(body, list):
+        if len(body) > max_events:
+            raise ValueError(f"Batch has {len(body)} events, the limit is {max_events}")
+        return body
+    if not isinstance(body, (bytes, str)):
+        raise ValueError("Batch is not a JSON array or NDJSON")
+    events = []
+    for number, line in enumerate(iter_lines(body), 1):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ValueError(f"Line {number} of the batch is not valid UTF-8")
+        if not line.strip():
+            continue
+        if len(events) == max_events:
+            raise ValueError(f"Batch has more than {max_events} events, the limit is {max_events}")
+        try:
+            events.append(codec.loads(line))
+        except ValueError:
+            events.append(None)
+    return events
+
+def encode_batch(event_type, events):
+    """ Validates the events of a batch and encodes the valid ones, returns
+    the result of each event and the messages to publish """
+    logger.info(f'Received event {event_type} batch request with {len(events)} events')
+    validator = EVENT_VALIDATORS[event_type]
+    results = []
+    messages = []
+    for position, event in enumerate(events):
+        if not isinstance(event, dict):
+            results.append({"index": position, "status": "rejected",
+                            "errors": ["Event is not a JSON object"]})
+            continue
+        errors = [error.message for error in validator.iter_errors(event)]
+        if errors:
+            results.append({"index": position, "status": "rejected", "errors": errors})
+            continue
+        trace_id = str(uuid.uuid4())
+        event['trace_id'] = trace_id
+        messages.append(codec.encode_event(event_type, event, BINARY_EVENTS))
+        results.append({"index": position, "status": "accepted", "trace_id": trace_id})
+    return results, messages
+
+def batch_response(event_type, events, results, messages):
+    """ Response of a published batch """
+    logger.info(f'Returned event {event_type} batch response, '
+                f'{len(messages)} accepted, {len(events) - len(messages)} rejected')
+    return {
+        "accepted": len(messages),
+        "rejected": len(events) - len(messages),
+        "results": results
+    }, 200
+
+def publish_batch(event_type, body):
+    """ Validates a batch of events and publishes the valid ones together """
+    try:
+        events = parse_batch(body, MAX_BATCH_EVENTS)
+    except ValueError as e:
+        logger.warning(f'Rejected event {event_type} batch request: {e}')
+        return {"message": str(e)}, 400
+    results, messages = encode_batch(event_type, events)
+    try:
+        producer.produce_batch(messages)
+    except QueueFullError:
+        logger.warning(f'Rejected event {event_type} batch request, event queue is full')
+        return {"message": "Event queue is full"}, 503
+    return batch_response(event_type, events, results, messages)
+
+def book_buy_batch(body):
+    return publish_batch('buy', body)
+
+def book_sell_batch(body):
+    return publish_batch('sell', body)
+
 def get_check():
     """Check if the service is healthy."""
     return NoContent, 200
 
+def get_producer_stats():
+    """ Gets the queue depth and flush latency of the event producer """
+    return producer.stats(), 200
+
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+class NDJSONRequestValidator(AbstractRequestBodyValidator):
+    """ Lets NDJSON batch bodies through to the handler, which validates each
+    event, instead of connexion's */*json validator parsing them as JSON """
+
+    async def wrap_receive(self, receive, *, scope):
+        return receive
+
+BODY_VALIDATORS = MediaTypeDict({
+    **validation.BODY_VALIDATORS,
+    "application/x-ndjson": NDJSONRequestValidator
+})
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/receiver", strict_validation=True,validate_responses=True)
+validation.configure(app_config.get('validation'))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api(SPEC_FILE, base_path="/receiver", strict_validation=True,validate_responses=True,
+            validator_map={"body": BODY_VALIDATORS, "response": validation.RESPONSE_VALIDATORS})
 
 if __name__ == "__main__":
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
     app.run(host="0.0.0.0",port=8080)
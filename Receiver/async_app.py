@@ -0,0 +1,93 @@
+""" Receiver served as an ASGI app: the same API and validation as app.py,
+with async handlers running on the event loop of each uvicorn worker.
+Producing never blocks the loop, the async producer only queues events and
+the sync producer waits for the broker's ack in a thread.
+
+    python async_app.py --workers 4
+    python -m uvicorn async_app:app --host 0.0.0.0 --port 8080 --workers 4
+"""
+import argparse
+import os
+import connexion
+from connexion import NoContent
+from connexion.resolver import Resolver
+import uvicorn
+import app as receiver
+from event_producer import QueueFullError
+import codec
+import validation
+
+logger = receiver.logger
+
+
+async def book_buy(body):
+    trace_id, message = receiver.encode_event("buy", body)
+    try:
+        await receiver.producer.produce_async(message)
+    except QueueFullError:
+        logger.warning(f'Rejected event buy request (Id: {trace_id}), event queue is full')
+        return {"message": "Event queue is full"}, 503
+    logger.info(f'Returned event buy response (Id: {trace_id}) with status 201')
+    return NoContent, 201
+
+async def book_sell(body):
+    trace_id, message = receiver.encode_event("sell", body)
+    try:
+        await receiver.producer.produce_async(message)
+    except QueueFullError:
+        logger.warning(f'Rejected event sell request (Id: {trace_id}), event queue is full')
+        return {"message": "Event queue is full"}, 503
+    logger.info(f'Returned event sell response (Id: {trace_id}) with status 201')
+    return NoContent, 201
+
+async def publish_batch(event_type, body):
+    """ Validates a batch of events and publishes the valid ones together """
+    try:
+        events = receiver.parse_batch(body, receiver.MAX_BATCH_EVENTS)
+    except ValueError as e:
+        logger.warning(f'Rejected event {event_type} batch request: {e}')
+        return {"message": str(e)}, 400
+    results, messages = receiver.encode_batch(event_type, events)
+    try:
+        await receiver.producer.produce_batch_async(messages)
+    except QueueFullError:
+        logger.warning(f'Rejected event {event_type} batch request, event queue is full')
+        return {"message": "Event queue is full"}, 503
+    return receiver.batch_response(event_type, events, results, messages)
+
+async def book_buy_batch(body):
+    return await publish_batch('buy', body)
+
+async def book_sell_batch(body):
+    return await publish_batch('sell', body)
+
+async def get_check():
+    """Check if the service is healthy."""
+    return NoContent, 200
+
+async def get_producer_stats():
+    """ Gets the queue depth and flush latency of the event producer """
+    return receiver.producer.stats(), 200
+
+async def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+def resolve_handler(operation_id):
+    """ Resolves the spec's app.<handler> operation ids to the handlers of this module """
+    return globals()[operation_id.rsplit('.', 1)[-1]]
+
+
+app = connexion.AsyncApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api(receiver.SPEC_FILE, base_path="/receiver", strict_validation=True, validate_responses=True,
+            resolver=Resolver(function_resolver=resolve_handler),
+            validator_map={"body": receiver.BODY_VALIDATORS, "response": validation.RESPONSE_VALIDATORS})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receiver service, ASGI mode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of uvicorn worker processes, each with its own producer")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    uvicorn.run("async_app:app", host="0.0.0.0", port=args.port, workers=args.workers)
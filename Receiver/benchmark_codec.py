@@ -0,0 +1,101 @@
+""" Benchmarks the cost per event and the size of events topic messages
+encoded with each JSON library installed, with the codec module, and in
+the codec's binary format, on a mix of buy and sell events.
+
+    python benchmark_codec.py
+    python benchmark_codec.py --events 100000 --repeat 5
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+import codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def make_messages(count):
+    """ Random buy and sell messages shaped like the Receiver's """
+    messages = []
+    for _ in range(count):
+        if random.random() < 0.5:
+            payload = {
+                "order_id": str(uuid.uuid4()),
+                "book_id": random.randint(1, 5000),
+                "user_id": str(uuid.uuid4()),
+                "name": "Atomic Habits",
+                "price": round(random.uniform(1, 100), 2),
+                "sold": True,
+                "trace_id": str(uuid.uuid4())
+            }
+            messages.append({"type": "buy", "datetime": "2024-06-29T09:12:33", "payload": payload})
+        else:
+            payload = {
+                "book_id": random.randint(1, 5000),
+                "user_id": str(uuid.uuid4()),
+                "name": "The Psychology of Money",
+                "listing_date": "2024-06-29T09:12:33",
+                "price": round(random.uniform(1, 100), 2),
+                "genre": "Non-Fiction",
+                "trace_id": str(uuid.uuid4())
+            }
+            messages.append({"type": "sell", "datetime": "2024-06-29T09:12:33", "payload": payload})
+    return messages
+
+
+def backends():
+    """ (name, encode, decode) of each library installed """
+    result = [("json", lambda obj: json.dumps(obj).encode("utf-8"), json.loads)]
+    if orjson is not None:
+        result.append(("orjson", orjson.dumps, orjson.loads))
+    if msgspec is not None:
+        result.append(("msgspec", msgspec.json.encode, msgspec.json.decode))
+        typed_decoder = msgspec.json.Decoder(codec.Event)
+        result.append(("msgspec typed", msgspec.json.encode, typed_decoder.decode))
+    result.append((f"codec ({codec.BACKEND})", codec.dumps, codec.decode_event))
+    result.append(("codec binary v1",
+                   lambda message: codec._encode_binary(message["type"], message["datetime"], message["payload"]),
+                   codec.decode_event))
+    return result
+
+
+def best_time(function, items, repeat):
+    """ Fastest of repeat runs of function over items, in seconds """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(event_count, repeat):
+    """ Prints the encode and decode cost per event of each backend """
+    messages = make_messages(event_count)
+    print(f"{'backend':>18} {'encode us':>10} {'decode us':>10} {'bytes':>6}")
+    for name, encode, decode in backends():
+        encoded = [encode(message) for message in messages]
+        encode_sec = best_time(encode, messages, repeat)
+        decode_sec = best_time(decode, encoded, repeat)
+        size = sum(len(data) for data in encoded) / event_count
+        print(f"{name:>18} {encode_sec * 1e6 / event_count:>10.3f} "
+              f"{decode_sec * 1e6 / event_count:>10.3f} {size:>6.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the JSON codec backends")
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.events, args.repeat)
@@ -0,0 +1,441 @@
+import asyncio
+import fcntl
+import logging
+import os
+import queue
+import struct
+import time
+from collections import Counter
+from threading import Thread, Lock
+from pykafka.common import CompressionType
+
+logger = logging.getLogger('basicLogger')
+
+COMPRESSION_TYPES = {
+    'none': CompressionType.NONE,
+    'gzip': CompressionType.GZIP,
+    'snappy': CompressionType.SNAPPY,
+    'lz4': CompressionType.LZ4
+}
+# How long a flush waits for the delivery reports of a batch
+DELIVERY_TIMEOUT_SEC = 30
+# Longest wait between attempts to deliver a batch Kafka did not ack
+MAX_RETRY_SEC = 30
+FSYNC_POLICIES = ('always', 'none')
+
+
+class QueueFullError(Exception):
+    """ Raised when the local event queue has no room for more events """
+
+
+class EventJournal:
+    """ On-disk journal of the events an async producer acknowledged
+
+    Events are appended as a 4-byte length and the encoded event, in the
+    order they are queued, and with fsync 'always' they are fsynced before
+    they are acknowledged. Concurrent appends share an fsync. The offset
+    up to which Kafka acked the events is kept in a .offset file, and the
+    events after it are replayed when the producer starts. Once the acked
+    events take compact_bytes, the unacked tail is copied to a new journal.
+
+    Offsets are logical, counted from the first event ever journaled; the
+    journal starts with the offset of its first event, so a crash between
+    a compaction and the .offset file update replays from the right place.
+
+    A process claims the first journal slot (filename.0, filename.1, ...)
+    no other process has locked, so each worker of the ASGI app has its
+    own journal, and a restarted worker replays the one left behind.
+    """
+
+    HEADER = struct.Struct('>Q')
+    RECORD = struct.Struct('>I')
+
+    def __init__(self, filename, fsync='always', compact_bytes=16 * 1024 * 1024, max_slots=64):
+        """
+        Args:
+            filename (str): Path of the journal, without the slot suffix.
+            fsync (str): 'always' to fsync appends before acknowledging,
+                'none' to leave writes to the OS, which survives a crash of
+                the process but not of the machine.
+            compact_bytes (int): Size of the acked events past which the
+                journal is compacted.
+            max_slots (int): Number of journal slots, at least the number
+                of processes producing.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.fsync = fsync == 'always'
+        self.compact_bytes = compact_bytes
+        self._lock = Lock()
+        self._sync_lock = Lock()
+        self._file, self.filename = self._claim(filename, max_slots)
+        self._offset_filename = self.filename + '.offset'
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.HEADER.size:
+            self._file.truncate(0)
+            self._file.write(self.HEADER.pack(0))
+            size = self.HEADER.size
+        self._file.seek(0)
+        self._base, = self.HEADER.unpack(self._file.read(self.HEADER.size))
+        self._end = self._base + size - self.HEADER.size
+        self._synced = self._end
+        self._acked = min(max(self._read_offset(), self._base), self._end)
+
+    def _claim(self, filename, max_slots):
+        """ Opens and locks the first journal slot no other process holds """
+        for slot in range(max_slots):
+            path = f"{filename}.{slot}"
+            file = open(path, 'a+b', buffering=0)
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            return file, path
+        raise RuntimeError(f"No free journal slot among {filename}.0 to {filename}.{max_slots - 1}")
+
+    def _read_offset(self):
+        try:
+            with open(self._offset_filename, 'r') as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _position(self, offset):
+        """ Position in the file of a logical offset """
+        return offset - self._base + self.HEADER.size
+
+    def pending(self):
+        """ The events Kafka did not ack, as (message, offset) pairs, after
+        truncating an event torn by a crash in the middle of an append """
+        with self._lock:
+            self._file.seek(self._position(self._acked))
+            data = self._file.read()
+            events = []
+            position = 0
+            while position + self.RECORD.size <= len(data):
+                size, = self.RECORD.unpack_from(data, position)
+                if position + self.RECORD.size + size > len(data):
+                    break
+                position += self.RECORD.size + size
+                events.append((data[position - size:position], self._acked + position))
+            if self._acked + position < self._end:
+                logger.warning(f"Truncating a partial event at the end of {self.filename}")
+                self._end = self._synced = self._acked + position
+                self._file.truncate(self._position(self._end))
+            return events
+
+    def append(self, messages):
+        """ Appends events, returns the offset after each. Call it in the
+        order the events are queued, then sync before acknowledging them """
+        data = b"".join(self.RECORD.pack(len(message)) + message for message in messages)
+        offsets = []
+        with self._lock:
+            offset = self._end
+            for message in messages:
+                offset += self.RECORD.size + len(message)
+                offsets.append(offset)
+            self._file.write(data)
+            self._end = offset
+        return offsets
+
+    def sync(self, offset):
+        """ Makes sure the events up to an offset are on disk, with one
+        fsync for every append made while the previous one ran """
+        if not self.fsync:
+            return
+        with self._sync_lock:
+            if self._synced >= offset:
+                return
+            with self._lock:
+                end = self._end
+            os.fsync(self._file.fileno())
+            self._synced = end
+
+    def checkpoint(self, offset):
+        """ Records that Kafka acked the events up to an offset, compacting
+        the journal once the acked events take compact_bytes """
+        with self._sync_lock, self._lock:
+            self._acked = offset
+            if self._acked - self._base >= self.compact_bytes:
+                self._compact()
+        tmp_filename = self._offset_filename + '.tmp'
+        with open(tmp_filename, 'w') as file:
+            file.write(str(offset))
+        # A lost update replays acked events, which Storage skips by trace id
+        os.replace(tmp_filename, self._offset_filename)
+
+    def _compact(self):
+        """ Replaces the journal with one holding only the unacked events """
+        self._file.seek(self._position(self._acked))
+        tail = self._file.read()
+        tmp_filename = self.filename + '.tmp'
+        file = open(tmp_filename, 'a+b', buffering=0)
+        # Locked before it replaces the journal, so no other process claims it
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        file.truncate(0)
+        file.write(self.HEADER.pack(self._acked) + tail)
+        os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+        self._file.close()
+        self._file = file
+        self._base = self._acked
+        self._synced = self._end
+        logger.info(f"Compacted {self.filename}, {len(tail)} bytes of unacked events")
+
+    def stats(self):
+        """ Size of the unacked events """
+        with self._lock:
+            return {"filename": self.filename, "pending_bytes": self._end - self._acked}
+
+
+class SyncEventProducer:
+    """ Produces each event to Kafka and waits for the broker to ack it """
+
+    mode = 'sync'
+
+    def __init__(self, topic):
+        """ Initializes a sync producer on the topic """
+        self._producer = topic.get_sync_producer()
+
+    def produce(self, message):
+        """ Produces an encoded event """
+        self._producer.produce(message)
+
+    def produce_batch(self, messages):
+        """ Produces encoded events one after another """
+        for message in messages:
+            self._producer.produce(message)
+
+    async def produce_async(self, message):
+        """ Produces an encoded event from a thread, so the event loop keeps
+        serving requests while the broker acks it """
+        await asyncio.to_thread(self.produce, message)
+
+    async def produce_batch_async(self, messages):
+        """ Produces encoded events from a thread """
+        await asyncio.to_thread(self.produce_batch, messages)
+
+    def stats(self):
+        """ Sync producers keep no queue """
+        return {"mode": self.mode}
+
+
+class StubEventProducer:
+    """ Stands in for the broker in load tests: waits latency_ms as if for
+    the broker's ack, then drops the event """
+
+    mode = 'stub'
+
+    def __init__(self, latency_ms=0):
+        """ Initializes a stub producer """
+        self.latency_sec = latency_ms / 1000
+        self._lock = Lock()
+        self._events = 0
+
+    def produce(self, message):
+        """ Drops an encoded event after the simulated ack """
+        self.produce_batch([message])
+
+    def produce_batch(self, messages):
+        """ Drops encoded events after one simulated ack """
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+        with self._lock:
+            self._events += len(messages)
+
+    async def produce_async(self, message):
+        """ Drops an encoded event after the simulated ack, without blocking the event loop """
+        await self.produce_batch_async([message])
+
+    async def produce_batch_async(self, messages):
+        """ Drops encoded events after one simulated ack, without blocking the event loop """
+        if self.latency_sec:
+            await asyncio.sleep(self.latency_sec)
+        with self._lock:
+            self._events += len(messages)
+
+    def stats(self):
+        """ Events dropped so far """
+        with self._lock:
+            return {"mode": self.mode, "events": self._events}
+
+
+class AsyncEventProducer:
+    """ Queues events locally and flushes them to Kafka in batches
+
+    Events are acknowledged once they are in the in-process queue and, with
+    a journal, appended to it on disk. A flush thread hands everything
+    queued (up to batch_size) to an async pykafka producer, which sends it
+    once batch_size events are pending or linger_ms has passed, then waits
+    for the delivery reports. Events keep queueing while a flush is in
+    flight, so batches grow with load.
+
+    A batch is retried with backoff until Kafka acks every event, and a
+    journal then records it as delivered. With a journal, delivery is at
+    least once: the unacked events are replayed on restart. Without one it
+    is at most once: the queued events are lost if the process dies.
+    """
+
+    mode = 'async'
+
+    def __init__(self, topic, queue_size, batch_size, linger_ms, compression='none', journal=None):
+        """ Initializes the producer, starts the flush thread and replays
+        the events of the journal Kafka did not ack """
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self._journal = journal
+        # (encoded event, journal offset after it) pairs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._put_lock = Lock()
+        self._producer = topic.get_producer(sync=False,
+                                            delivery_reports=True,
+                                            linger_ms=linger_ms,
+                                            min_queued_messages=batch_size,
+                                            max_queued_messages=queue_size,
+                                            compression=COMPRESSION_TYPES[compression])
+        self._stats_lock = Lock()
+        self._stats = {
+            "batches": 0,
+            "events": 0,
+            "retried": 0,
+            "rejected": 0,
+            "replayed": 0,
+            "flush_errors": 0,
+            "last_error": None,
+            "last_batch_size": 0,
+            "last_flush_ms": 0,
+            "max_flush_ms": 0,
+            "total_flush_ms": 0
+        }
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f"Async producer started, queue size {queue_size}, "
+                    f"batch size {batch_size}, linger {linger_ms}ms, compression {compression}, "
+                    f"journal {journal.filename if journal is not None else 'none'}")
+        if journal is not None:
+            pending = journal.pending()
+            for item in pending:
+                # Blocks while the flush thread makes room
+                self._queue.put(item)
+            with self._stats_lock:
+                self._stats["replayed"] = len(pending)
+            if pending:
+                logger.info(f"Replaying {len(pending)} events Kafka did not ack from {journal.filename}")
+
+    def produce(self, message):
+        """ Queues an encoded event, raises QueueFullError if there is no room """
+        self.produce_batch([message])
+
+    def produce_batch(self, messages):
+        """ Queues encoded events all together, or none of them if there is
+        no room, returning once they are journaled """
+        with self._put_lock:
+            if self.queue_size - self._queue.qsize() < len(messages):
+                with self._stats_lock:
+                    self._stats["rejected"] += len(messages)
+                raise QueueFullError(f"Event queue is full ({self.queue_size} events)")
+            # Journaled in queue order, so an offset checkpoint covers
+            # every event before it
+            offsets = self._journal.append(messages) if self._journal is not None else [None] * len(messages)
+            for item in zip(messages, offsets):
+                self._queue.put_nowait(item)
+        if self._journal is not None:
+            self._journal.sync(offsets[-1])
+
+    async def produce_async(self, message):
+        """ Queues an encoded event """
+        await self.produce_batch_async([message])
+
+    async def produce_batch_async(self, messages):
+        """ Queues encoded events all together, or none of them. Queueing
+        never waits on the broker, so it runs on the event loop unless the
+        journal fsyncs """
+        if self._journal is not None and self._journal.fsync:
+            await asyncio.to_thread(self.produce_batch, messages)
+        else:
+            self.produce_batch(messages)
+
+    def stats(self):
+        """ Queue depth and flush latency of the producer """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        total_flush_ms = stats.pop("total_flush_ms")
+        stats["avg_flush_ms"] = round(total_flush_ms / stats["batches"], 3) if stats["batches"] else 0
+        stats["mode"] = self.mode
+        stats["queue_depth"] = self._queue.qsize()
+        stats["queue_size"] = self.queue_size
+        stats["flush_thread_alive"] = self._thread.is_alive()
+        if self._journal is not None:
+            stats["journal"] = self._journal.stats()
+        return stats
+
+    def _run(self):
+        """ Flushes queued events to Kafka for the lifetime of the producer """
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._flush(batch)
+            if self._journal is not None:
+                try:
+                    self._journal.checkpoint(batch[-1][1])
+                except OSError as e:
+                    # The events are delivered, a later checkpoint covers them
+                    logger.error(f"Failed to checkpoint the journal: {e}")
+
+    def _flush(self, batch):
+        """ Produces a batch and waits until the broker acked every event,
+        retrying the events it did not ack with backoff """
+        started = time.monotonic()
+        pending = [message for message, _ in batch]
+        retry_sec = 0.1
+        while True:
+            try:
+                pending = self._deliver(pending)
+            except Exception as e:
+                # The flush thread must outlive any error, or the queue fills
+                # up and every request is rejected until a restart
+                logger.error(f"Failed to flush {len(pending)} events: {e}")
+                with self._stats_lock:
+                    self._stats["flush_errors"] += 1
+                    self._stats["last_error"] = str(e)
+            if not pending:
+                break
+            logger.warning(f"Kafka did not ack {len(pending)} events, retrying in {retry_sec:.1f}s")
+            with self._stats_lock:
+                self._stats["retried"] += len(pending)
+            time.sleep(retry_sec)
+            retry_sec = min(retry_sec * 2, MAX_RETRY_SEC)
+
+        flush_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["events"] += len(batch)
+            self._stats["last_batch_size"] = len(batch)
+            self._stats["last_flush_ms"] = round(flush_ms, 3)
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], round(flush_ms, 3))
+            self._stats["total_flush_ms"] += flush_ms
+        logger.debug(f"Flushed batch of {len(batch)} events in {flush_ms:.1f}ms, "
+                     f"queue depth {self._queue.qsize()}")
+
+    def _deliver(self, messages):
+        """ Produces events and returns the ones the broker did not ack """
+        for message in messages:
+            self._producer.produce(message)
+        # Reports are matched by value, as a report of an earlier attempt
+        # that timed out can arrive in place of one of this attempt
+        unacked = Counter(messages)
+        for _ in messages:
+            try:
+                msg, exc = self._producer.get_delivery_report(block=True, timeout=DELIVERY_TIMEOUT_SEC)
+            except queue.Empty:
+                break
+            if exc is not None:
+                logger.warning(f"Failed to deliver event: {exc}")
+            elif unacked[msg.value]:
+                unacked[msg.value] -= 1
+        return list(unacked.elements())
@@ -0,0 +1,123 @@
+""" Load tests a running Receiver with concurrent buy and sell events, and
+reports the requests per second and the p50/p99 latency. Run the Receiver
+with producer mode 'stub' in its app_conf.yml to measure it against the
+stand-in broker rather than Kafka, e.g.
+
+    python app.py                          # Flask app
+    python async_app.py --workers 4        # ASGI app
+    python load_test.py --requests 20000 --concurrency 64 --processes 4
+    python load_test.py --batch 100        # batch endpoints, 100 events a request
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+import uuid
+import httpx
+
+GENRES = ["Fiction", "Non-Fiction", "Mystery", "Science", "Fantasy"]
+
+
+def make_event(event_type):
+    """ A random event shaped like the Receiver's """
+    if event_type == "buy":
+        return {
+            "order_id": str(uuid.uuid4()),
+            "book_id": random.randint(1, 5000),
+            "user_id": str(uuid.uuid4()),
+            "name": "Atomic Habits",
+            "price": round(random.uniform(1, 100), 2),
+            "sold": True
+        }
+    return {
+        "book_id": random.randint(1, 5000),
+        "user_id": str(uuid.uuid4()),
+        "name": "The Psychology of Money",
+        "listing_date": "2024-06-29T09:12:33",
+        "price": round(random.uniform(1, 100), 2),
+        "genre": random.choice(GENRES)
+    }
+
+
+async def send_requests(url, count, concurrency, batch):
+    """ Sends count requests over concurrency connections, returns the
+    latency of each request in seconds and the count of each status """
+    latencies = []
+    statuses = {}
+    remaining = count
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def client_loop(client):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            event_type = random.choice(["buy", "sell"])
+            if batch:
+                path = f"{url}/books/{event_type}/batch"
+                body = [make_event(event_type) for _ in range(batch)]
+            else:
+                path = f"{url}/books/{event_type}"
+                body = make_event(event_type)
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, json=body)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return latencies, statuses
+
+
+def run_process(args):
+    """ Entry point of a load generating process """
+    return asyncio.run(send_requests(*args))
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of sorted values """
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run(url, count, concurrency, processes, batch):
+    """ Prints the throughput and latency of the Receiver under load """
+    shares = [count // processes + (1 if i < count % processes else 0) for i in range(processes)]
+    started = time.perf_counter()
+    if processes == 1:
+        results = [run_process((url, count, concurrency, batch))]
+    else:
+        # Several processes, so the client is not the bottleneck of a multi-worker server
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(run_process, [(url, share, concurrency, batch) for share in shares])
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for process_latencies, _ in results for latency in process_latencies)
+    statuses = {}
+    for _, process_statuses in results:
+        for status, status_count in process_statuses.items():
+            statuses[status] = statuses.get(status, 0) + status_count
+
+    print(f"{count} requests in {elapsed:.2f}s, {processes} processes x {concurrency} connections"
+          + (f", {batch} events a request" if batch else ""))
+    print(f"Throughput {count / elapsed:,.0f} requests/sec"
+          + (f", {count * batch / elapsed:,.0f} events/sec" if batch else ""))
+    print(f"Latency p50 {percentile(latencies, 0.50) * 1000:.2f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}ms, max {latencies[-1] * 1000:.2f}ms")
+    print("Statuses " + ", ".join(f"{status}: {status_count}" for status, status_count in sorted(
+        statuses.items(), key=lambda item: str(item[0]))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the Receiver")
+    parser.add_argument("--url", default="http://localhost:8080/receiver")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32, help="connections per process")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=0,
+                        help="events per request to the batch endpoints (default: single events)")
+    args = parser.parse_args()
+    run(args.url, args.requests, args.concurrency, args.processes, args.batch)
@@ -1,7 +1,9 @@
 import connexion
 from connexion import NoContent
-import uuid
-from sqlalchemy import create_engine,and_
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import AbstractResponseBodyValidator
+from flask import Response
+from sqlalchemy import create_engine,and_,insert,func,select
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from book_buy import BookBuy
@@ -10,11 +12,16 @@ import yaml
 import logging
 import logging.config
 import datetime
-import json
-from pykafka import KafkaClient
+import codec
+import validation
+from kafka_pool import KafkaPool
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Thread, Event
+import argparse
+import multiprocessing
 import os
+import signal
+import time
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -56,132 +63,413 @@ Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 logger.info(f"Connecting to db, hostname={hostname}, port={port}")
 
-def book_buy(body):
-    """ Receives a new buy event """
-    #response = requests.post('http://127.0.0.1:8080/books/buy')
-    session = DB_SESSION()
-    trace_id = body['trace_id']
-    purchase = BookBuy(body['order_id'],
-                        body['book_id'],
-                        body['user_id'],
-                        body['name'],
-                        body['price'],
-                        body['sold'],
-                        body['trace_id'])
-
-    session.add(purchase)
-    event_name = 'buy'
-    logger.debug(f"Stored event {event_name} request with a trace id of {trace_id}")
-    session.commit()
-    session.close()
-
-    #return NoContent, response.status_code
-    return NoContent, 201
+# Settings missing from configs of older versions take the defaults of app_conf.yml
+STREAM_CHUNK_SIZE = app_config.get('query', {}).get('stream_chunk_size', 1000)
+CONSUMER_GROUP = app_config["events"].get("consumer_group", "storage_group")
+BALANCED = app_config["events"].get("balanced", False)
+BATCH_MAX_SIZE = app_config.get("batch", {}).get("max_size", 100)
+BATCH_LINGER_MS = app_config.get("batch", {}).get("linger_ms", 500)
+WORKERS_CONFIG = app_config.get("workers", {})
+
+KAFKA_POOL = KafkaPool("%s:%d" % (app_config["events"]["hostname"],
+                                  app_config["events"]["port"]))
+# Consumer of process_messages, once its thread has connected
+CONSUMER = None
+# Number of writer processes, 0 when process_messages runs in a thread
+NUM_WORKERS = 0
+# Longest wait between attempts to write a batch while the database is down
+MAX_RETRY_SEC = 30
+
+def events_query(model, start_timestamp, end_timestamp, after_id, limit):
+    """ Query for a table's events in a time window, ordered by id so
+    results can be paged through with after_id and limit """
+    start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
+    end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
 
+    # Plain columns, so rows map straight to JSON objects without loading
+    # ORM instances and copying them field by field
+    query = select(*model.__table__.columns).where(
+        and_(
+            model.date_created >= start_timestamp_datetime,
+            model.date_created < end_timestamp_datetime))
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+    query = query.order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def stream_events(query, event_name, start_timestamp):
+    """ Streams the results of a query as NDJSON, reading rows in chunks
+    from a server-side cursor so memory stays flat whatever the window size """
+    def generate():
+        session = DB_SESSION()
+        count = 0
+        try:
+            results = session.execute(query.execution_options(stream_results=True,
+                                                              yield_per=STREAM_CHUNK_SIZE)).mappings()
+            for result in results:
+                count += 1
+                yield codec.dumps(dict(result)) + b'\n'
+        finally:
+            session.close()
+            logger.info(f"Streamed {count} {event_name} events after {start_timestamp}")
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def get_events(model, event_name, start_timestamp, end_timestamp, after_id, limit, stream):
+    """ Gets a table's events in a time window, as a JSON list or an NDJSON stream """
+    query = events_query(model, start_timestamp, end_timestamp, after_id, limit)
+    if stream:
+        return stream_events(query, event_name, start_timestamp)
 
-def book_sell(body):
-    """ Receives a new sale event """
     session = DB_SESSION()
-    trace_id = body['trace_id']
-    sale = BookSell(body['book_id'],
-                   body['user_id'],
-                   body['name'],
-                   body['listing_date'],
-                   body['price'],
-                   body['genre'],
-                   body['trace_id']
-                   )
-
-    session.add(sale)
-    event_name = 'sale'
-    logger.debug(f"Stored event {event_name} request with a trace id of {trace_id}")
-    session.commit()
+
+    results_list = [dict(result) for result in session.execute(query).mappings()]
+
     session.close()
 
-    #return NoContent, response.status_code
-    return NoContent, 201
+    logger.info(f"Query for {event_name} event after {start_timestamp} returns {len(results_list)} results")
 
-def get_books_buy(start_timestamp, end_timestamp):
+    return results_list, 200, {'Content-Type': 'application/json'}
+
+def get_books_buy(start_timestamp, end_timestamp, after_id=None, limit=None, stream=False):
     """ Gets new book buy events between the start and end timestamps """
+    return get_events(BookBuy, 'Book Buy', start_timestamp, end_timestamp, after_id, limit, stream)
+
+def get_books_sell(start_timestamp, end_timestamp, after_id=None, limit=None, stream=False):
+    """ Gets new book sell events between the start and end timestamps """
+    return get_events(BookSell, 'Book Sell', start_timestamp, end_timestamp, after_id, limit, stream)
+
+def window_stats(session, model, start_timestamp_datetime, end_timestamp_datetime):
+    """ Aggregates the prices of a table's events in a time window """
+    count, max_price, min_price, sum_price, avg_price = session.query(
+        func.count(model.id),
+        func.max(model.price),
+        func.min(model.price),
+        func.sum(model.price),
+        func.avg(model.price)).filter(
+            and_(
+                model.date_created >= start_timestamp_datetime,
+                model.date_created < end_timestamp_datetime)).one()
+
+    return {
+        "count": count,
+        "max_price": max_price,
+        "min_price": min_price,
+        "sum_price": sum_price,
+        "avg_price": float(avg_price) if avg_price is not None else None
+    }
+
+def get_window_stats(start_timestamp, end_timestamp):
+    """ Gets price aggregates of the book buy and sell events between the start and end timestamps """
 
     session = DB_SESSION()
 
     start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
 
-    results = session.query(BookBuy).filter(
-        and_(
-            BookBuy.date_created >= start_timestamp_datetime,
-            BookBuy.date_created < end_timestamp_datetime))
-    
-    results_list = []
-
-    for result in results:
-        results_list.append(result.to_dict())
-
-    session.close()
-
-    logger.info(f"Query for Book Buy event after {start_timestamp} returns {len(results_list)} results")
-
-    return results_list, 200
-
+    try:
+        stats = {
+            "buy": window_stats(session, BookBuy, start_timestamp_datetime, end_timestamp_datetime),
+            "sell": window_stats(session, BookSell, start_timestamp_datetime, end_timestamp_datetime)
+        }
+    finally:
+        session.close()
 
-
-def get_books_sell(start_timestamp, end_timestamp):
-    """ Gets new book sell events between the start and end timestamps """
+    logger.info(f"Query for window stats after {start_timestamp} returns "
+                f"{stats['buy']['count']} buy and {stats['sell']['count']} sell events")
+
+    return stats, 200
+
+def minute_bucket(column):
+    """ The minute of a datetime column, as a timestamp string """
+    if DB_ENGINE.dialect.name == 'sqlite':
+        return func.strftime('%Y-%m-%dT%H:%M:00', column)
+    return func.date_format(column, '%Y-%m-%dT%H:%i:00')
+
+def minute_stats(session, model, start_timestamp_datetime, end_timestamp_datetime, genres=False):
+    """ Aggregates the prices of a table's events in a time window by minute,
+    with the count of each genre if asked """
+    in_window = and_(model.date_created >= start_timestamp_datetime,
+                     model.date_created < end_timestamp_datetime)
+    minute = minute_bucket(model.date_created)
+    buckets = {}
+    for start, count, sum_price, min_price, max_price in session.query(
+            minute,
+            func.count(model.id),
+            func.sum(model.price),
+            func.min(model.price),
+            func.max(model.price)).filter(in_window).group_by(minute).order_by(minute):
+        buckets[start] = {
+            "start": start,
+            "count": count,
+            "sum_price": float(sum_price),
+            "min_price": min_price,
+            "max_price": max_price
+        }
+        if genres:
+            buckets[start]["genres"] = {}
+
+    if genres:
+        for start, genre, count in session.query(
+                minute, model.genre, func.count(model.id)).filter(in_window).group_by(minute, model.genre):
+            buckets[start]["genres"][genre] = count
+
+    return list(buckets.values())
+
+def get_window_minute_stats(start_timestamp, end_timestamp):
+    """ Gets price aggregates of the book buy and sell events between the start and end timestamps, by minute """
 
     session = DB_SESSION()
 
     start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
 
-    results = session.query(BookSell).filter(
-        and_(
-            BookSell.date_created >= start_timestamp_datetime,
-            BookSell.date_created < end_timestamp_datetime))
-    
-    results_list = []
-
-    for result in results:
-        results_list.append(result.to_dict())
+    try:
+        stats = {
+            "buy": minute_stats(session, BookBuy, start_timestamp_datetime, end_timestamp_datetime),
+            "sell": minute_stats(session, BookSell, start_timestamp_datetime, end_timestamp_datetime, genres=True)
+        }
+    finally:
+        session.close()
 
-    session.close()
+    logger.info(f"Query for window minute stats after {start_timestamp} returns "
+                f"{len(stats['buy'])} buy and {len(stats['sell'])} sell minutes")
+
+    return stats, 200
+
+def buy_row(payload, date_created):
+    """ Column values for a book buy event, for bulk insert """
+    return {
+        'order_id': payload['order_id'],
+        'book_id': payload['book_id'],
+        'user_id': payload['user_id'],
+        'name': payload['name'],
+        'price': payload['price'],
+        'sold': payload['sold'],
+        'date_created': date_created,
+        'trace_id': payload['trace_id']
+    }
+
+def sell_row(payload, date_created):
+    """ Column values for a book sell event, for bulk insert """
+    return {
+        'book_id': payload['book_id'],
+        'user_id': payload['user_id'],
+        'name': payload['name'],
+        'listing_date': payload['listing_date'],
+        'price': payload['price'],
+        'genre': payload['genre'],
+        'date_created': date_created,
+        'trace_id': payload['trace_id']
+    }
+
+def insert_new_events(model):
+    """ Multi-row insert of a model that skips rows whose trace_id is
+    already stored, so replayed messages are not stored twice """
+    # Ignored rows are not counted in the rowcount, unlike a no-op
+    # ON DUPLICATE KEY UPDATE with the FOUND_ROWS flag SQLAlchemy sets
+    return insert(model).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+def event_datetime(msg, default):
+    """ When the Receiver received an event, so a replayed event keeps its
+    place in time, or the default if the message does not say """
+    try:
+        return datetime.datetime.fromisoformat(msg['datetime'][:19])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+def write_batch(messages):
+    """ Writes a batch of decoded event messages in a single transaction,
+    with one multi-row insert per table. Events already stored, by trace
+    id, are skipped, so a batch can be written again after a crash.
+    Returns the number of buy and sell events inserted. """
+    now = datetime.datetime.now().replace(microsecond=0)
+    buy_rows = []
+    sell_rows = []
+    for msg in messages:
+        event_type = msg.get('type')
+        date_created = event_datetime(msg, now)
+        try:
+            if event_type == 'buy':
+                buy_rows.append(buy_row(msg['payload'], date_created))
+            elif event_type == 'sell':
+                sell_rows.append(sell_row(msg['payload'], date_created))
+            else:
+                logger.warning(f"Unknown event type: {event_type}")
+        except KeyError as e:
+            logger.warning(f"Skipping malformed {event_type} event, missing field {e}")
 
-    logger.info(f"Query for Book Sell event after {start_timestamp} returns {len(results_list)} results")
+    session = DB_SESSION()
+    try:
+        # Core executes on the session's connection report the rows
+        # inserted, which leaves out the duplicates
+        conn = session.connection()
+        num_buy = num_sell = 0
+        if buy_rows:
+            num_buy = conn.execute(insert_new_events(BookBuy), buy_rows).rowcount
+        if sell_rows:
+            num_sell = conn.execute(insert_new_events(BookSell), sell_rows).rowcount
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
-    return results_list, 200
+    return num_buy, num_sell
 
-def process_messages():
-    """ Process event messages """
-    hostname = "%s:%d" % (app_config["events"]["hostname"],
-                          app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    # Create a consume on a consumer group, that only reads new messages
-    # (uncommitted messages) when the service re-starts (i.e., it doesn't
-    # read all the old messages from the history in the message queue).
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group',
+def store_batch(consumer, batch, batch_started):
+    """ Writes a batch to the database and commits its offsets, returns
+    False if the write failed and the batch has to be retried """
+    write_started = time.monotonic()
+    try:
+        num_buy, num_sell = write_batch(batch)
+    except Exception as e:
+        # Offsets are not committed, so the batch is kept and retried
+        logger.error(f"Failed to write batch of {len(batch)} messages: {e}")
+        return False
+    write_ms = (time.monotonic() - write_started) * 1000
+
+    # Only commit the offsets once the batch is safely in the database
+    consumer.commit_offsets()
+    total_ms = (time.monotonic() - batch_started) * 1000
+    logger.info(f"Stored batch of {len(batch)} messages "
+                f"({num_buy} buy, {num_sell} sell inserted, "
+                f"{len(batch) - num_buy - num_sell} duplicate or malformed), "
+                f"db write {write_ms:.1f}ms, batch latency {total_ms:.1f}ms, "
+                f"{len(batch) / (total_ms / 1000):.0f} events/sec")
+    return True
+
+def process_messages(partition_ids=None, stop_event=None):
+    """ Process event messages in batches
+
+    Args:
+        partition_ids (list): Partitions to consume, all of them by default.
+        stop_event (Event): Set to flush the current batch and stop.
+    """
+    batch_size = BATCH_MAX_SIZE
+    linger_sec = BATCH_LINGER_MS / 1000
+    global CONSUMER
+    # Create a consume on the service's consumer group, that only reads new
+    # messages (uncommitted messages) when the service re-starts (i.e., it
+    # doesn't read all the old messages from the history in the message queue).
+    # In balanced mode the replicas of the service share the partitions.
+    # The consumer timeout lets us flush a partial batch once the linger
+    # time has passed even if no new messages arrive.
+    consumer = KAFKA_POOL.group_consumer(app_config["events"]["topic"],
+                                         CONSUMER_GROUP,
+                                         balanced=BALANCED and partition_ids is None,
+                                         partition_ids=partition_ids,
                                          reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
-    # This is blocking - it will wait for a new message
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-
-        payload = msg["payload"]
-        event_type = msg['type']
-        if msg["type"] == "buy":
-            book_buy(payload)
-
-        elif msg["type"] == "sell":
-            book_sell(payload)
+                                         auto_offset_reset=OffsetType.LATEST,
+                                         consumer_timeout_ms=BATCH_LINGER_MS)
+    CONSUMER = consumer
+    logger.info(f"Batching messages, max size {batch_size}, linger {linger_sec}s")
+
+    batch = []
+    batch_started = None
+    while stop_event is None or not stop_event.is_set():
+        msg = consumer.consume()
+        if msg is not None:
+            try:
+                batch.append(codec.decode_event(msg.value))
+            except Exception as e:
+                logger.error(f"Skipping malformed message at offset {msg.offset} "
+                             f"of partition {msg.partition_id}: {e}")
+                if not batch:
+                    # Nothing read before it is uncommitted, so commit past
+                    # it now, otherwise it is committed with the batch
+                    consumer.commit_offsets()
+                continue
+            if batch_started is None:
+                batch_started = time.monotonic()
+
+        if not batch:
+            continue
+        if len(batch) < batch_size and time.monotonic() - batch_started < linger_sec:
+            continue
+
+        # While the database is down, hold the batch and retry it alone
+        # rather than consuming more messages into it, backing off between
+        # attempts
+        retry_sec = linger_sec
+        while not store_batch(consumer, batch, batch_started):
+            if stop_event is not None and stop_event.wait(retry_sec):
+                break
+            if stop_event is None:
+                time.sleep(retry_sec)
+            retry_sec = min(retry_sec * 2, MAX_RETRY_SEC)
         else:
-            logger.warning(f"Unknown event type: {event_type}")
-
-        # Commit the new message as being read
-        consumer.commit_offsets()
-        logger.info(f"Processed and committed offset for message with trace id {payload.get('trace_id')}")
+            batch = []
+            batch_started = None
+
+    # Stopping: store what was read so far, or leave it uncommitted to be
+    # read again on restart
+    if batch and not store_batch(consumer, batch, batch_started):
+        logger.warning(f"Stopped with {len(batch)} uncommitted messages, they will be re-read")
+    consumer.stop()
+
+def worker_partitions(worker_index, num_workers):
+    """ Partitions owned by a worker, the ones whose id modulo the number
+    of workers is the worker's index """
+    topic = KAFKA_POOL.topic(app_config["events"]["topic"])
+    return sorted(partition_id for partition_id in topic.partitions
+                  if partition_id % num_workers == worker_index)
+
+def run_worker(worker_index, num_workers):
+    """ Entry point of a writer process
+
+    The process imports this module afresh, so it has its own SQLAlchemy
+    engine and Kafka client. SIGTERM and SIGINT make it flush its batch,
+    commit the offsets and exit.
+    """
+    stop_event = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    partition_ids = worker_partitions(worker_index, num_workers)
+    if not partition_ids:
+        logger.warning(f"Writer {worker_index} has no partitions to consume, "
+                       f"the topic has fewer partitions than {num_workers} workers")
+        return
+    logger.info(f"Writer {worker_index} (pid {os.getpid()}) consuming partitions {partition_ids}")
+    process_messages(partition_ids, stop_event)
+    logger.info(f"Writer {worker_index} stopped")
+
+def supervise_workers(num_workers, stop_event):
+    """ Starts the writer processes and restarts any that exit, until
+    stop_event is set, then stops them gracefully """
+    context = multiprocessing.get_context("spawn")
+    restart_delay_sec = WORKERS_CONFIG.get("restart_delay_sec", 5)
+    workers = {}
+    while not stop_event.is_set():
+        for worker_index in range(num_workers):
+            worker = workers.get(worker_index)
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                if worker.exitcode == 0:
+                    # Exited on purpose, e.g. no partitions to consume
+                    continue
+                logger.error(f"Writer {worker_index} exited with code {worker.exitcode}, restarting")
+            worker = context.Process(target=run_worker, args=(worker_index, num_workers),
+                                     name=f"storage-writer-{worker_index}", daemon=True)
+            worker.start()
+            workers[worker_index] = worker
+        stop_event.wait(restart_delay_sec)
+
+    logger.info(f"Stopping {len(workers)} writers")
+    for worker in workers.values():
+        if worker.is_alive():
+            worker.terminate()
+    deadline = time.monotonic() + WORKERS_CONFIG.get("shutdown_timeout_sec", 30)
+    for worker in workers.values():
+        worker.join(max(deadline - time.monotonic(), 0))
+        if worker.is_alive():
+            logger.error(f"Writer {worker.name} did not stop in time, killing it")
+            worker.kill()
 
 def get_event_stats():
     """ Gets event stats in History """
@@ -205,12 +493,75 @@ def get_event_stats():
     logger.error("Could not event stats")
     return { "message": "Not Found"}, 404
 
-
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/storage", strict_validation=True, validate_responses=True)
+def get_consumer_lag():
+    """ Gets the offsets and lag of the partitions this replica consumes """
+    if NUM_WORKERS:
+        # The writers run in other processes, use the offsets they committed
+        with KAFKA_POOL.consumer(app_config["events"]["topic"],
+                                 consumer_group=str.encode(CONSUMER_GROUP),
+                                 auto_start=False,
+                                 reset_offset_on_fetch=False) as consumer:
+            partitions = KAFKA_POOL.partition_lag(consumer, committed=True)
+    elif CONSUMER is None:
+        return { "message": "Consumer not started"}, 503
+    else:
+        partitions = KAFKA_POOL.partition_lag(CONSUMER)
+    return {
+                "consumer_group": CONSUMER_GROUP,
+                "balanced": BALANCED and not NUM_WORKERS,
+                "workers": NUM_WORKERS,
+                "total_lag": sum(partition["lag"] for partition in partitions),
+                "partitions": partitions
+            }, 200
+
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+class StreamingResponseValidator(AbstractResponseBodyValidator):
+    """ Lets streamed NDJSON responses through instead of buffering the
+    whole body to validate it as JSON """
+
+    def wrap_send(self, send):
+        return send
+
+RESPONSE_VALIDATORS = MediaTypeDict({
+    **validation.RESPONSE_VALIDATORS,
+    "application/x-ndjson": StreamingResponseValidator
+})
+
+# The event lists skip the schema check by default, as in app_conf.yml
+validation.configure(app_config.get('validation', {'endpoints': {'app.get_books_buy': 'request_only',
+                                                                 'app.get_books_sell': 'request_only'}}))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map={"body": validation.BODY_VALIDATORS, "response": RESPONSE_VALIDATORS})
 
 if __name__ == "__main__":
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
-    app.run(host="0.0.0.0",port=8090)
+    parser = argparse.ArgumentParser(description="Storage service")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of writer processes, each owning a share of the partitions "
+                             "(default: consume in a thread of the API process)")
+    args = parser.parse_args()
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
+
+    if args.workers > 0:
+        NUM_WORKERS = args.workers
+        stop_workers = Event()
+        supervisor = Thread(target=supervise_workers, args=(args.workers, stop_workers))
+        supervisor.start()
+
+        def shutdown(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, shutdown)
+        try:
+            app.run(host="0.0.0.0",port=8090)
+        finally:
+            stop_workers.set()
+            supervisor.join()
+    else:
+        t1 = Thread(target=process_messages)
+        t1.setDaemon(True)
+        t1.start()
+        app.run(host="0.0.0.0",port=8090)
@@ -0,0 +1,99 @@
+""" Benchmarks the Storage time window queries against table size, with and
+without the date_created indexes, on a seeded local SQLite database.
+
+    python benchmark_window_query.py
+    python benchmark_window_query.py --sizes 10000 100000 1000000 --window-minutes 60
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+CREATE_TABLE = '''
+CREATE TABLE book_sell
+(id INTEGER PRIMARY KEY AUTOINCREMENT,
+ book_id INT NOT NULL,
+ user_id VARCHAR(36) NOT NULL,
+ name VARCHAR(100) NOT NULL,
+ listing_date VARCHAR(100) NOT NULL,
+ price FLOAT NOT NULL,
+ genre VARCHAR(100) NOT NULL,
+ date_created DATETIME NOT NULL,
+ trace_id VARCHAR(36) NOT NULL)
+'''
+
+INDEXES = {
+    "none": [],
+    "date_created": ["CREATE INDEX ix_book_sell_date_created ON book_sell (date_created)"],
+    "covering": ["CREATE INDEX ix_book_sell_date_created_price ON book_sell (date_created, price)"]
+}
+
+QUERIES = {
+    "rows": "SELECT * FROM book_sell WHERE date_created >= ? AND date_created < ?",
+    "aggregates": ("SELECT COUNT(id), MAX(price), MIN(price), SUM(price), AVG(price) FROM book_sell "
+                   "WHERE date_created >= ? AND date_created < ?")
+}
+
+EVENTS_PER_MINUTE = 20
+
+
+def seed(conn, size):
+    """ Inserts size events, EVENTS_PER_MINUTE per minute, ending now """
+    end = datetime.datetime.now().replace(microsecond=0)
+    start = end - datetime.timedelta(minutes=size // EVENTS_PER_MINUTE)
+    rows = []
+    for i in range(size):
+        date_created = start + datetime.timedelta(seconds=i * 60 // EVENTS_PER_MINUTE)
+        rows.append((random.randint(1, 5000), str(uuid.uuid4()), "The Psychology of Money",
+                     "2024-06-29T09:12:33", round(random.uniform(1, 100), 2), "Non-Fiction",
+                     date_created.strftime('%Y-%m-%d %H:%M:%S'), str(uuid.uuid4())))
+    conn.executemany("INSERT INTO book_sell (book_id, user_id, name, listing_date, price, genre, "
+                     "date_created, trace_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return end
+
+
+def time_query(conn, query, params, repeat):
+    """ Average latency of a query in milliseconds """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(query, params).fetchall()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+def plan(conn, query, params):
+    """ The SQLite query plan of a query """
+    return "; ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params))
+
+
+def run(sizes, window_minutes, repeat):
+    """ Prints the latency of each query per table size and index """
+    print(f"{'rows':>10} {'index':>13} {'query':>11} {'ms':>9}  plan")
+    for size in sizes:
+        for index_name, statements in INDEXES.items():
+            with tempfile.TemporaryDirectory() as directory:
+                conn = sqlite3.connect(os.path.join(directory, "bookstore.sqlite"))
+                conn.execute(CREATE_TABLE)
+                for statement in statements:
+                    conn.execute(statement)
+                end = seed(conn, size)
+                start = end - datetime.timedelta(minutes=window_minutes)
+                params = (start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'))
+                for query_name, query in QUERIES.items():
+                    latency = time_query(conn, query, params, repeat)
+                    print(f"{size:>10} {index_name:>13} {query_name:>11} {latency:>9.3f}  "
+                          f"{plan(conn, query, params)}")
+                conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the Storage time window queries")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 500000])
+    parser.add_argument("--window-minutes", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.sizes, args.window_minutes, args.repeat)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, Index
 from sqlalchemy.sql.functions import now
 from base import Base
 import datetime
@@ -8,6 +8,10 @@ class BookBuy(Base):
     """ Book Buy """
 
     __tablename__ = "book_buy"
+    __table_args__ = (
+        Index("ix_book_buy_date_created", "date_created"),
+        Index("ix_book_buy_trace_id", "trace_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     order_id = Column(String(36), nullable=False)
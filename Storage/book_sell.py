@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, Index
 from sqlalchemy.sql.functions import now
 from base import Base
 import datetime
@@ -8,6 +8,10 @@ class BookSell(Base):
     """ Book Sell """
 
     __tablename__ = "book_sell"
+    __table_args__ = (
+        Index("ix_book_sell_date_created", "date_created"),
+        Index("ix_book_sell_trace_id", "trace_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     book_id = Column(Integer, nullable=False)
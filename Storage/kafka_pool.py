@@ -0,0 +1,166 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+
+logger = logging.getLogger('basicLogger')
+
+
+class KafkaPool:
+    """ Process-wide pool of a connected Kafka client and idle consumers """
+
+    def __init__(self, hosts, max_idle=4):
+        """ Initializes the pool, the client connects on first use """
+        self.hosts = hosts
+        self.max_idle = max_idle
+        self._lock = Lock()
+        self._timings_lock = Lock()
+        self._client = None
+        self._generation = 0
+        self._idle = {}
+        self._timings = {}
+        self._reconnects = 0
+
+    def client(self):
+        """ Returns the shared client, reconnecting if it is unhealthy """
+        with self._lock:
+            if self._client is not None and not self._is_healthy(self._client):
+                logger.warning(f"Kafka client for {self.hosts} lost its brokers, reconnecting")
+                self._reconnects += 1
+                self._client = None
+            if self._client is None:
+                with self.timed('connect'):
+                    self._client = KafkaClient(hosts=self.hosts)
+                # Consumers of the old client are dropped instead of reused
+                self._generation += 1
+                self._idle = {}
+                logger.info(f"Connected Kafka client to {self.hosts}")
+            return self._client
+
+    def topic(self, name):
+        """ Returns a topic of the shared client """
+        return self.client().topics[str.encode(name)]
+
+    def group_consumer(self, topic_name, consumer_group, balanced=False, partition_ids=None, **kwargs):
+        """ Creates a long-lived consumer in a consumer group
+
+        A simple consumer reads every partition of the topic, or only
+        partition_ids. A balanced consumer joins the group through Kafka's
+        group management and is assigned a share of the partitions, so
+        running more replicas of a service spreads the partitions between
+        them.
+        """
+        topic = self.topic(topic_name)
+        with self.timed('connect'):
+            if balanced:
+                return topic.get_balanced_consumer(consumer_group=str.encode(consumer_group),
+                                                   managed=True, **kwargs)
+            partitions = None
+            if partition_ids is not None:
+                partitions = [topic.partitions[partition_id] for partition_id in partition_ids]
+            return topic.get_simple_consumer(consumer_group=str.encode(consumer_group),
+                                             partitions=partitions, **kwargs)
+
+    @contextmanager
+    def consumer(self, topic_name, partition_ids=None, **kwargs):
+        """ Borrows a simple consumer and returns it to the pool afterwards
+
+        Consumers are pooled by topic, partitions and consumer options. A
+        consumer is discarded instead of returned if the block raised or the
+        client was reconnected while it was borrowed.
+        """
+        key = (topic_name, tuple(partition_ids or ()), tuple(sorted(kwargs.items())))
+        topic = self.topic(topic_name)
+        consumer = None
+        with self._lock:
+            generation = self._generation
+            idle = self._idle.get(key)
+            if idle:
+                consumer = idle.pop()
+
+        if consumer is None:
+            partitions = None
+            if partition_ids is not None:
+                partitions = [topic.partitions[partition_id] for partition_id in partition_ids]
+            with self.timed('connect'):
+                consumer = topic.get_simple_consumer(partitions=partitions, **kwargs)
+
+        healthy = False
+        try:
+            yield consumer
+            healthy = True
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if healthy and generation == self._generation and len(idle) < self.max_idle:
+                    idle.append(consumer)
+                    consumer = None
+            if consumer is not None:
+                consumer.stop()
+
+    @contextmanager
+    def timed(self, name):
+        """ Records the latency of a block under a counter name """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self._timings_lock:
+                count, total_ms = self._timings.get(name, (0, 0.0))
+                self._timings[name] = (count + 1, total_ms + elapsed_ms)
+
+    def stats(self):
+        """ Latency counters of connection setup and fetches """
+        result = {"reconnects": self._reconnects}
+        with self._timings_lock:
+            timings = dict(self._timings)
+        for name, (count, total_ms) in timings.items():
+            result[name] = {
+                "count": count,
+                "total_ms": round(total_ms, 3),
+                "avg_ms": round(total_ms / count, 3) if count else 0
+            }
+        return result
+
+    @staticmethod
+    def partition_lag(consumer, committed=False):
+        """ Offsets and lag of each partition a consumer currently owns
+
+        The lag is the number of messages between the last message the
+        consumer read and the end of the partition. With committed, the
+        offsets committed to the consumer group are used instead, which
+        covers consumers running in other processes.
+        """
+        if committed:
+            # Committed offsets are the next offset to read, -1 if none
+            held_offsets = {partition_id: response.offset - 1 if response.offset >= 0 else OffsetType.EARLIEST
+                            for partition_id, response in consumer.fetch_offsets()}
+        else:
+            held_offsets = consumer.held_offsets or {}
+        partitions = []
+        for partition_id, partition in sorted(consumer.partitions.items()):
+            latest_offset = partition.latest_available_offset()
+            consumed_offset = held_offsets.get(partition_id, OffsetType.EARLIEST)
+            if consumed_offset >= 0:
+                next_offset = consumed_offset + 1
+            else:
+                # Nothing read from the partition yet, it lags from its start
+                next_offset = partition.earliest_available_offset()
+            partitions.append({
+                "partition": partition_id,
+                "consumed_offset": consumed_offset if consumed_offset >= 0 else None,
+                "latest_offset": latest_offset,
+                "lag": max(latest_offset - next_offset, 0)
+            })
+        return partitions
+
+    @staticmethod
+    def _is_healthy(client):
+        """ A client is healthy while it is connected to at least one broker """
+        try:
+            return any(broker.connected for broker in client.brokers.values())
+        except Exception:
+            return False
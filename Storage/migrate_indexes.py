@@ -0,0 +1,151 @@
+""" Adds the time window and unique trace id indexes to the book_buy and
+book_sell tables of an existing database, and checks with EXPLAIN that the
+time window queries use them.
+
+    python migrate_indexes.py                 # add missing indexes
+    python migrate_indexes.py --dedupe        # also delete duplicate trace ids
+    python migrate_indexes.py --covering      # also add (date_created, price)
+    python migrate_indexes.py --explain       # only check the query plans
+    python migrate_indexes.py --url sqlite:///bookstore.sqlite
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+import yaml
+from sqlalchemy import create_engine, inspect, text, Index
+from book_buy import BookBuy
+from book_sell import BookSell
+
+MODELS = [BookBuy, BookSell]
+
+WINDOW_QUERIES = {
+    "rows": "SELECT * FROM {table} WHERE date_created >= :start AND date_created < :end",
+    "aggregates": ("SELECT COUNT(id), MAX(price), MIN(price), SUM(price), AVG(price) FROM {table} "
+                   "WHERE date_created >= :start AND date_created < :end")
+}
+
+
+def database_url():
+    """ Builds the database URL from the Storage app configuration """
+    if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+        app_conf_file = "/config/app_conf.yml"
+    else:
+        app_conf_file = "app_conf.yml"
+    with open(app_conf_file, 'r') as f:
+        datastore = yaml.safe_load(f.read())['datastore']
+    return (f"mysql+pymysql://{datastore['user']}:{datastore['password']}"
+            f"@{datastore['hostname']}:{datastore['port']}/{datastore['db']}")
+
+
+def covering_index(model):
+    """ Index that answers the price aggregates of a window without reading rows """
+    table = model.__table__
+    return Index(f"ix_{table.name}_date_created_price", table.c.date_created, table.c.price)
+
+
+def count_duplicates(engine, table):
+    """ Number of rows whose trace_id is also stored in an older row """
+    with engine.connect() as conn:
+        return conn.execute(text(f"SELECT COUNT(*) - COUNT(DISTINCT trace_id) FROM {table}")).scalar()
+
+
+def delete_duplicates(engine, table):
+    """ Deletes all but the oldest row of each trace_id """
+    # The derived table lets MySQL delete from the table it selects from
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN "
+            f"(SELECT id FROM (SELECT MIN(id) AS id FROM {table} GROUP BY trace_id) AS oldest)"))
+    return result.rowcount
+
+
+def migrate(engine, covering, dedupe):
+    """ Creates the indexes of the models that the database is missing, and
+    makes the trace_id indexes unique. Returns False if duplicate trace ids
+    prevent that. """
+    inspector = inspect(engine)
+    migrated = True
+    for model in MODELS:
+        table = model.__table__
+        existing = {index['name']: index for index in inspector.get_indexes(table.name)}
+        indexes = list(table.indexes)
+        if covering:
+            indexes.append(covering_index(model))
+        for index in indexes:
+            if index.name in existing and bool(existing[index.name]['unique']) == index.unique:
+                print(f"{table.name}: {index.name} already exists")
+                continue
+            if index.unique:
+                duplicates = count_duplicates(engine, table.name)
+                if duplicates and not dedupe:
+                    print(f"{table.name}: {duplicates} rows have a duplicate trace_id, "
+                          f"run with --dedupe to delete them before creating {index.name}")
+                    migrated = False
+                    continue
+                if duplicates:
+                    print(f"{table.name}: deleted {delete_duplicates(engine, table.name)} duplicate rows")
+            started = time.monotonic()
+            if index.name in existing:
+                # Index was created before trace ids were unique
+                index.drop(engine)
+            index.create(engine)
+            print(f"{table.name}: created {index.name} in {time.monotonic() - started:.2f}s")
+    return migrated
+
+
+def explain(engine):
+    """ Prints the plan of the window queries, returns False if no index can
+    serve one of them """
+    end = datetime.datetime.now().replace(microsecond=0)
+    params = {"start": end - datetime.timedelta(hours=1), "end": end}
+    all_indexed = True
+    with engine.connect() as conn:
+        for model in MODELS:
+            table = model.__table__.name
+            if engine.dialect.name != "sqlite":
+                # The optimizer plans with the table statistics, which are
+                # stale right after the indexes are created
+                conn.execute(text(f"ANALYZE TABLE {table}")).all()
+            for name, query in WINDOW_QUERIES.items():
+                sql = query.format(table=table)
+                if engine.dialect.name == "sqlite":
+                    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params).all()
+                    plan = "; ".join(row[-1] for row in rows)
+                    chosen = indexed = "INDEX" in plan
+                else:
+                    rows = conn.execute(text(f"EXPLAIN {sql}"), params).mappings().all()
+                    plan = "; ".join(f"type={row['type']} possible_keys={row['possible_keys']} key={row['key']}"
+                                     for row in rows)
+                    chosen = all(row['key'] for row in rows)
+                    # MySQL scans a small table even when an index fits the
+                    # query, so an index it could use passes too
+                    indexed = all(row['key'] or row['possible_keys'] for row in rows)
+                all_indexed = all_indexed and indexed
+                if chosen:
+                    status = "OK"
+                elif indexed:
+                    status = "OK, index available but a table scan was chosen"
+                else:
+                    status = "NO INDEX"
+                print(f"{table} {name} query: {status} ({plan})")
+    return all_indexed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds the Storage time window indexes")
+    parser.add_argument("--url", help="database URL, defaults to the app_conf.yml datastore")
+    parser.add_argument("--covering", action="store_true",
+                        help="also add (date_created, price) covering indexes for price aggregates")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="delete rows with a duplicate trace_id, keeping the oldest, "
+                             "so the unique trace_id indexes can be created")
+    parser.add_argument("--explain", action="store_true",
+                        help="only check the query plans, without changing the schema")
+    args = parser.parse_args()
+
+    engine = create_engine(args.url or database_url())
+    migrated = args.explain or migrate(engine, args.covering, args.dedupe)
+    indexed = explain(engine)
+    sys.exit(0 if migrated and indexed else 1)
@@ -13,7 +13,9 @@ CREATE TABLE book_buy
  sold BOOLEAN NOT NULL,
  date_created DATETIME NOT NULL,
  trace_id VARCHAR(36) NOT NULL,
- CONSTRAINT book_buy_pk PRIMARY KEY (id))
+ CONSTRAINT book_buy_pk PRIMARY KEY (id),
+ INDEX ix_book_buy_date_created (date_created),
+ UNIQUE INDEX ix_book_buy_trace_id (trace_id))
 ''')
 
 db_cursor.execute('''
@@ -27,7 +29,9 @@ CREATE TABLE book_sell
  genre VARCHAR(100) NOT NULL,
  date_created DATETIME NOT NULL,
  trace_id VARCHAR(36) NOT NULL,
- CONSTRAINT book_sell_pk PRIMARY KEY (id))
+ CONSTRAINT book_sell_pk PRIMARY KEY (id),
+ INDEX ix_book_sell_date_created (date_created),
+ UNIQUE INDEX ix_book_sell_trace_id (trace_id))
 ''')
 db_conn.commit()
 db_conn.close()
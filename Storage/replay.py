@@ -0,0 +1,109 @@
+""" Re-consumes a range of offsets of the events topic into the Storage
+database, and reports the throughput. Events already stored are skipped by
+trace_id, so a range can be replayed over a live database, e.g. to recover
+from a crash or a restore. The consumer group offsets of the service are
+not changed.
+
+    python replay.py                                  # whole topic
+    python replay.py --start 1000 --end 5000          # offsets [1000, 5000) of each partition
+    python replay.py --partitions 0 2 --batch-size 1000
+    python replay.py --url sqlite:///bookstore.sqlite
+"""
+import argparse
+import time
+from pykafka.common import OffsetType
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import app
+import codec
+
+# A replayed partition with no message for this long is considered done
+CONSUMER_TIMEOUT_MS = 5000
+
+
+def offset_ranges(topic, partition_ids, start, end):
+    """ The [first, last) offsets to replay of each partition, clamped to
+    the offsets the partition still has """
+    ranges = {}
+    for partition_id in partition_ids:
+        partition = topic.partitions[partition_id]
+        earliest = partition.earliest_available_offset()
+        latest = partition.latest_available_offset()
+        first = earliest if start is None else max(start, earliest)
+        last = latest if end is None else min(end, latest)
+        if first < last:
+            ranges[partition_id] = (first, last)
+    return ranges
+
+
+def replay(partition_ids, start, end, batch_size):
+    """ Writes the events of the offset ranges in batches, prints the totals """
+    topic = app.KAFKA_POOL.topic(app.app_config["events"]["topic"])
+    ranges = offset_ranges(topic, partition_ids or sorted(topic.partitions), start, end)
+    if not ranges:
+        print("Nothing to replay")
+        return
+    for partition_id, (first, last) in sorted(ranges.items()):
+        print(f"partition {partition_id}: offsets {first} to {last - 1}, {last - first} events")
+
+    # No consumer group, so nothing is committed for the service's group
+    consumer = topic.get_simple_consumer(partitions=[topic.partitions[partition_id] for partition_id in ranges],
+                                         consumer_timeout_ms=CONSUMER_TIMEOUT_MS)
+    # reset_offsets takes the last consumed offset, EARLIEST to read offset 0
+    consumer.reset_offsets([(topic.partitions[partition_id], first - 1 if first > 0 else OffsetType.EARLIEST)
+                            for partition_id, (first, last) in ranges.items()])
+
+    remaining = set(ranges)
+    batch = []
+    read = inserted = 0
+    write_sec = 0.0
+    started = time.monotonic()
+
+    def flush():
+        nonlocal inserted, write_sec
+        write_started = time.monotonic()
+        num_buy, num_sell = app.write_batch(batch)
+        write_sec += time.monotonic() - write_started
+        inserted += num_buy + num_sell
+        batch.clear()
+
+    while remaining:
+        msg = consumer.consume()
+        if msg is None:
+            print(f"No messages for {CONSUMER_TIMEOUT_MS}ms, stopping with partitions {sorted(remaining)} unfinished")
+            break
+        last = ranges[msg.partition_id][1]
+        if msg.offset >= last:
+            remaining.discard(msg.partition_id)
+            continue
+        batch.append(codec.decode_event(msg.value))
+        read += 1
+        if msg.offset == last - 1:
+            remaining.discard(msg.partition_id)
+        if len(batch) >= batch_size:
+            flush()
+            elapsed = time.monotonic() - started
+            print(f"{read} events read, {inserted} inserted, {read / elapsed:.0f} events/sec")
+    if batch:
+        flush()
+    consumer.stop()
+
+    elapsed = time.monotonic() - started
+    print(f"Replayed {read} events in {elapsed:.2f}s: {inserted} inserted, "
+          f"{read - inserted} already stored or malformed")
+    print(f"Throughput {read / elapsed:.0f} events/sec, "
+          f"database writes {write_sec:.2f}s ({write_sec / elapsed:.0%} of the time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a range of the events topic into Storage")
+    parser.add_argument("--start", type=int, help="first offset of each partition, defaults to the earliest")
+    parser.add_argument("--end", type=int, help="offset to stop before in each partition, defaults to the latest")
+    parser.add_argument("--partitions", type=int, nargs="+", help="partitions to replay, defaults to all")
+    parser.add_argument("--batch-size", type=int, default=app.BATCH_MAX_SIZE)
+    parser.add_argument("--url", help="database URL, defaults to the app_conf.yml datastore")
+    args = parser.parse_args()
+
+    if args.url:
+        app.DB_SESSION = sessionmaker(bind=create_engine(args.url))
+    replay(args.partitions, args.start, args.end, args.batch_size)
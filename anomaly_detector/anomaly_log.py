@@ -0,0 +1,160 @@
+"""
+Append-only anomaly log
+
+Anomalies are appended to a JSON lines file and fsynced in batches, and
+kept in memory in one deque per anomaly type, in timestamp order, so reads
+never touch the file. Each type has a version, bumped by every anomaly
+added, for conditional GETs. Compaction rewrites the file with only the retained
+anomalies.
+"""
+
+import logging
+import os
+import codec
+from conditional import Version
+from collections import defaultdict, deque
+from threading import Lock
+
+logger = logging.getLogger('basicLogger')
+
+
+class AnomalyLog:
+    """ Append-only JSON lines log of anomalies, indexed in memory by type """
+
+    def __init__(self, filename, fsync_batch, max_per_type):
+        """
+        Loads the anomalies already in the log and opens it for appending.
+
+        Args:
+            filename (str): Path of the JSON lines file.
+            fsync_batch (int): Number of appends between fsyncs.
+            max_per_type (int): Number of anomalies retained per type.
+        """
+        self.filename = filename
+        self.fsync_batch = fsync_batch
+        self.max_per_type = max_per_type
+        self._lock = Lock()
+        self._by_type = defaultdict(deque)
+        self._versions = defaultdict(Version)
+        self._unsynced = 0
+        corrupt = self._load()
+        self._file = open(self.filename, 'a')
+        if corrupt:
+            # Rewrite the log so new lines are not appended to a partial one
+            self.compact()
+
+    def append(self, anomaly):
+        """ Appends an anomaly to the log, fsyncing every fsync_batch appends """
+        line = codec.dumps_str(anomaly)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._insert(anomaly)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch:
+                self._sync()
+
+    def flush(self):
+        """ Fsyncs any appends that are not on disk yet """
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+
+    def import_legacy(self, filename):
+        """ Imports the anomalies of the JSON file datastore, if the log has
+        no anomalies yet. Returns whether anomalies were imported """
+        with self._lock:
+            if any(self._by_type.values()) or not os.path.exists(filename):
+                return False
+        try:
+            with open(filename, 'rb') as file:
+                anomalies = codec.loads(file.read())
+            anomalies = sorted(anomalies, key=lambda x: x["timestamp"])
+        except (ValueError, KeyError, TypeError) as e:
+            # A file truncated by a crash of the JSON datastore
+            logger.error(f"Could not import the anomalies of {filename}: {e}")
+            return False
+        for anomaly in anomalies:
+            self.append(anomaly)
+        self.flush()
+        logger.info(f"Imported {len(anomalies)} anomalies of {filename}")
+        return True
+
+    def get(self, anomaly_type, limit=None, since=None):
+        """
+        Returns anomalies of a type, newest first.
+
+        Args:
+            anomaly_type (str): Anomaly type, e.g. 'Too High'.
+            limit (int): Maximum number of anomalies to return.
+            since (str): Only return anomalies with a later timestamp.
+        """
+        result = []
+        with self._lock:
+            for anomaly in reversed(self._by_type.get(anomaly_type, ())):
+                if since is not None and anomaly['timestamp'] <= since:
+                    break
+                if limit is not None and len(result) >= limit:
+                    break
+                result.append(anomaly)
+        return result
+
+    def version(self, anomaly_type):
+        """ Version of the anomalies of a type """
+        with self._lock:
+            return self._versions[anomaly_type]
+
+    def compact(self):
+        """ Rewrites the log with only the retained anomalies, in timestamp order """
+        with self._lock:
+            self._sync()
+            anomalies = sorted((anomaly for entries in self._by_type.values() for anomaly in entries),
+                               key=lambda x: x["timestamp"])
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'w') as f:
+                for anomaly in anomalies:
+                    f.write(codec.dumps_str(anomaly) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_filename, self.filename)
+            self._file = open(self.filename, 'a')
+        logger.info(f"Compacted anomaly log to {len(anomalies)} anomalies")
+
+    def _insert(self, anomaly):
+        """ Adds an anomaly to its type's deque, keeping timestamp order """
+        entries = self._by_type[anomaly['anomaly_type']]
+        # Anomalies are detected in timestamp order, so this is almost always an append
+        position = len(entries)
+        while position > 0 and entries[position - 1]['timestamp'] > anomaly['timestamp']:
+            position -= 1
+        entries.insert(position, anomaly)
+        if len(entries) > self.max_per_type:
+            entries.popleft()
+        self._versions[anomaly['anomaly_type']].bump()
+
+    def _sync(self):
+        """ Flushes and fsyncs the log file, the lock must be held """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def _load(self):
+        """ Reads the anomalies already in the log, returns True if it had corrupt lines """
+        if not os.path.exists(self.filename):
+            logger.info(f"Creating anomaly log: {self.filename}")
+            return False
+        count = 0
+        corrupt = False
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    anomaly = codec.loads(line)
+                except ValueError:
+                    # A crash can leave a partial last line, compaction drops it
+                    logger.warning(f"Skipping corrupt line in anomaly log: {line!r}")
+                    corrupt = True
+                    continue
+                self._insert(anomaly)
+                count += 1
+        logger.info(f"Loaded {count} anomalies from {self.filename}")
+        return corrupt
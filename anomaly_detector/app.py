@@ -1,25 +1,30 @@
 """
 Anomaly Detector Service
 
-This service identifies anomalies in financial transactions based on thresholds
-for 'buy' and 'sell' prices. It uses Kafka to process events and maintains
-an anomaly data store.
+This service identifies anomalies in financial transactions using the rules
+configured in app_conf.yml. It uses Kafka to process events in micro-batches
+and maintains an anomaly data store.
 """
 
 
 # Import required libraries and modules
 import connexion
 from connexion import NoContent
-import json
 import datetime
 import os
 import requests
 import yaml
 import logging
 import logging.config
-from pykafka import KafkaClient
+from kafka_pool import KafkaPool
 from pykafka.common import OffsetType
 from threading import Thread
+from apscheduler.schedulers.background import BackgroundScheduler
+from anomaly_log import AnomalyLog
+import codec
+import validation
+from rules import RuleEngine, threshold_rules
+from broadcaster import Broadcaster, SSEMiddleware
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -40,110 +45,185 @@ logger.info(f"Running in {env.upper()} environment")
 logger.info(f"App Conf File: {app_conf_file}")
 logger.info(f"Log Conf File: {log_conf_file}")
 
-# Constants for anomaly detection
-HIGH_VALUE = app_config["thresholds"]["high_value"]
-LOW_VALUE = app_config["thresholds"]["low_value"]
-data_store = app_config['data_store']['filename']
-
-logger.info(f"Anomaly thresholds - High Value: {HIGH_VALUE}, Low Value: {LOW_VALUE}")
-
-# Ensure datastore exists
-if not os.path.exists(data_store):
-    logger.info(f"Creating data store: {data_store}")
-    with open(data_store, 'w') as f:
-        json.dump([], f)
+# Rules for anomaly detection, or the thresholds of configs from before the rules
+if 'rules' in app_config:
+    RULE_ENGINE = RuleEngine(app_config['rules'])
+else:
+    logger.warning("No rules configured, using the rules equivalent to the thresholds")
+    RULE_ENGINE = RuleEngine(threshold_rules(app_config['thresholds']))
+
+# Settings missing from configs of older versions take the defaults of app_conf.yml
+data_store_config = app_config.get('data_store', app_config.get('datastore', {}))
+events_config = app_config['events']
+stream_config = app_config.get('stream', {})
+CONSUMER_GROUP = events_config.get("consumer_group", "anomaly_group")
+BALANCED = events_config.get("balanced", False)
+if 'legacy_filename' in data_store_config:
+    data_store = data_store_config['filename']
+    legacy_data_store = data_store_config['legacy_filename']
+else:
+    # Configs from before the anomaly log name the JSON file datastore
+    legacy_data_store = data_store_config.get('filename', 'data.json')
+    data_store = os.path.join(os.path.dirname(legacy_data_store), 'anomalies.jsonl')
+    logger.warning(f"No legacy_filename configured, importing {legacy_data_store} into {data_store}")
+# Query names of the anomaly types, e.g. TooHigh for 'Too High'
+ANOMALY_TYPES = {rule.anomaly_type.replace(' ', ''): rule.anomaly_type for rule in RULE_ENGINE.rules}
+BATCH_MAX_SIZE = app_config.get('batch', {}).get('max_size', 500)
+BATCH_TIMEOUT_MS = app_config.get('batch', {}).get('timeout_ms', 100)
+
+logger.info(f"Loaded {len(RULE_ENGINE.rules)} anomaly rules: {list(ANOMALY_TYPES.values())}")
+
+KAFKA_POOL = KafkaPool(f"{events_config['hostname']}:{events_config['port']}")
+# Consumer of find_anomalies, once its thread has connected
+CONSUMER = None
+
+ANOMALY_LOG = AnomalyLog(data_store,
+                         data_store_config.get('fsync_batch', 10),
+                         data_store_config.get('max_per_type', 10000))
+ANOMALY_LOG.import_legacy(legacy_data_store)
+
+def latest_anomalies():
+    """ The newest anomaly of each anomaly type and event type, sent to
+    clients of /anomalies/stream when they connect """
+    latest = []
+    for anomaly_type in ANOMALY_TYPES.values():
+        event_types = set()
+        for anomaly in ANOMALY_LOG.get(anomaly_type):
+            if anomaly["event_type"] not in event_types:
+                event_types.add(anomaly["event_type"])
+                latest.append(("anomaly", anomaly))
+    return latest
+
+# Pushes every anomaly found to the clients of /anomalies/stream
+ANOMALY_BROADCASTER = Broadcaster(latest_anomalies,
+                                  stream_config.get('queue_size', 1000),
+                                  stream_config.get('keepalive_sec', 15))
+
+def consume_batch(consumer):
+    """
+    Collects up to BATCH_MAX_SIZE events, returning early when no message
+    arrives within BATCH_TIMEOUT_MS.
+    """
+    events = []
+    while len(events) < BATCH_MAX_SIZE:
+        msg = consumer.consume()
+        if msg is None:
+            break
+        events.append(codec.decode_event(msg.value))
+    return events
 
 def find_anomalies():
     """
-    Processes events from Kafka and identifies anomalies based on thresholds.
-    Detected anomalies are logged and stored in the anomaly data store.
+    Processes events from Kafka in micro-batches and evaluates the anomaly
+    rules on each batch. Detected anomalies are logged and stored in the
+    anomaly data store.
     """    
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(
-        consumer_group=b'event_group',
+    global CONSUMER
+    consumer = KAFKA_POOL.group_consumer(
+        events_config["topic"],
+        CONSUMER_GROUP,
+        balanced=BALANCED,
         reset_offset_on_start=False,
-        auto_offset_reset=OffsetType.LATEST
+        auto_offset_reset=OffsetType.LATEST,
+        consumer_timeout_ms=BATCH_TIMEOUT_MS
     )
+    CONSUMER = consumer
 
-    with open(data_store, 'r') as f:
-        anomalies = json.load(f)
+    while True:
+        events = consume_batch(consumer)
+        if not events:
+            continue
+        logger.info(f"Received batch of {len(events)} events")
 
-    for msg in consumer:
-        msg_str = msg.value.decode("utf-8")
-        event = json.loads(msg_str)
-        logger.info(f"Message received: {event}")
-
-        payload = event["payload"]
-        event_type = event["type"]
-        price = payload["price"]
         current_timestamp = datetime.datetime.now().isoformat()
-
-        anomaly = None
-        # Detect anomalies based on price thresholds
-        if event_type == "buy" and price <= LOW_VALUE:
+        for event, rule in RULE_ENGINE.evaluate(events):
+            payload = event["payload"]
             anomaly = {
                 "event_id": payload["user_id"],
                 "trace_id": payload["trace_id"],
-                "event_type": event_type,
-                "anomaly_type": "Too Low",
-                "description": f"Buy price too low: {price} falls below {LOW_VALUE}",
+                "event_type": event["type"],
+                "anomaly_type": rule.anomaly_type,
+                "description": rule.describe(event),
                 "timestamp": current_timestamp,
             }
-        elif event_type == "sell" and price >= HIGH_VALUE:
-            anomaly = {
-                "event_id": payload["user_id"],
-                "trace_id": payload["trace_id"],
-                "event_type": event_type,
-                "anomaly_type": "Too High",
-                "description": f"Sell price too high: {price} exceeds {HIGH_VALUE}",
-                "timestamp": current_timestamp,
-            }
-
-        if anomaly:
-            anomalies.append(anomaly)
+            ANOMALY_LOG.append(anomaly)
+            ANOMALY_BROADCASTER.publish("anomaly", anomaly)
             logger.info(f"Anomaly detected and added: {anomaly}")
-            with open(data_store, 'w') as f:
-                json.dump(anomalies, f, indent=4)
 
         consumer.commit_offsets()
 
-def get_anomalies(anomaly_type):
+def get_anomalies(anomaly_type, limit=None, since=None):
     """
     Retrieves anomalies of a specific type ('TooHigh' or 'TooLow') from the data store.
 
     Args:
-        anomaly_type (str): Type of anomalies to retrieve ('TooHigh' or 'TooLow').
+        anomaly_type (str): Type of anomalies to retrieve, e.g. 'TooHigh' or 'TooLow'.
+        limit (int): Maximum number of anomalies to return.
+        since (str): Only return anomalies detected after this timestamp.
 
     Returns:
-        tuple: Sorted list of anomalies and HTTP status code.
+        tuple: Sorted list of anomalies, HTTP status code and the ETag and
+            Last-Modified headers, or an empty 304 if the client has the
+            current anomalies of the type.
     """    
     logger.info('Get anomalies request received.')
 
-    with open(data_store, 'r') as file:
-            anomalies = json.load(file)
-    too_high_anomalies = []
-    too_low_anomalies = []
-    # Filter anomalies based on type
-    for anomaly in anomalies:
-        if anomaly['anomaly_type'] == 'Too High':
-            too_high_anomalies.append(anomaly)
-        if anomaly['anomaly_type'] == 'Too Low':
-            too_low_anomalies.append(anomaly)
-            
-    if anomaly_type == 'TooHigh':
-        response = sorted(too_high_anomalies, key=lambda x: x["timestamp"], reverse=True)
-    elif anomaly_type == 'TooLow':
-        response = sorted(too_low_anomalies, key=lambda x: x["timestamp"], reverse=True)
-    else:
+    if anomaly_type not in ANOMALY_TYPES:
         response = {"anomalies": [], "message": "No anomalies detected."}
+        logger.info(f"Response returned: {response}")
+        return response, 200
+
+    # Checked before reading the anomalies, so the body is never older than its ETag
+    not_modified, headers = ANOMALY_LOG.version(ANOMALY_TYPES[anomaly_type]).check(connexion.request.headers)
+    if not_modified:
+        logger.info('Anomalies not modified since the version the client has.')
+        return NoContent, 304, headers
+
+    response = ANOMALY_LOG.get(ANOMALY_TYPES[anomaly_type], limit=limit, since=since)
     logger.info(f"Response returned: {response}")
-    return response, 200
+    return response, 200, headers
+
+def get_consumer_lag():
+    """
+    Retrieves the offsets and lag of the partitions this replica consumes.
+
+    Returns:
+        tuple: Lag of the consumer group and HTTP status code.
+    """
+    if CONSUMER is None:
+        return {"message": "Consumer not started"}, 503
+    partitions = KAFKA_POOL.partition_lag(CONSUMER)
+    return {
+        "consumer_group": CONSUMER_GROUP,
+        "balanced": BALANCED,
+        "total_lag": sum(partition["lag"] for partition in partitions),
+        "partitions": partitions
+    }, 200
+
+def init_scheduler():
+    """
+    Schedules the batched fsync and the compaction of the anomaly log.
+    """
+    sched = BackgroundScheduler(daemon=True)
+    sched.add_job(ANOMALY_LOG.flush,
+                  'interval',
+                  seconds=data_store_config.get('fsync_interval_sec', 1))
+    sched.add_job(ANOMALY_LOG.compact,
+                  'interval',
+                  seconds=data_store_config.get('compact_interval_sec', 3600))
+    sched.start()
 
 # Connexion app setup
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
+
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
+
+validation.configure(app_config.get('validation'))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api("BHAVDEEPSINGH_1-OnlineBookstore-1.0.0-resolved.yaml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True,
+            validator_map=validation.VALIDATOR_MAP)
 app.add_middleware(
     CORSMiddleware,
     position=MiddlewarePosition.BEFORE_EXCEPTION,
@@ -152,13 +232,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    SSEMiddleware,
+    position=MiddlewarePosition.BEFORE_ROUTING,
+    path="/anomaly_detector/anomalies/stream",
+    broadcaster=ANOMALY_BROADCASTER,
+)
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
 
 if __name__ == "__main__":
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
     # Start the anomaly detection thread and run the app
     t1 = Thread(target=find_anomalies)
     t1.setDaemon(True)
     t1.start()
+    init_scheduler()
     app.run(host="0.0.0.0", port=8120)
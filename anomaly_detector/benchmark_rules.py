@@ -0,0 +1,87 @@
+""" Benchmarks the anomaly rule engine throughput against the number of
+rules, for micro-batches of synthetic buy and sell events, next to the
+per-event Python checks it replaced.
+
+    python benchmark_rules.py
+    python benchmark_rules.py --events 200000 --batch-size 500 --rules 2 8 32
+"""
+import argparse
+import random
+import time
+import uuid
+from rules import RuleEngine
+
+GENRES = ["Fiction", "Non-Fiction", "Mystery", "Science", "Fantasy"]
+
+
+def make_events(count):
+    """ Random buy and sell events shaped like the Receiver's """
+    events = []
+    for _ in range(count):
+        events.append({
+            "type": random.choice(["buy", "sell"]),
+            "payload": {
+                "book_id": random.randint(1, 5000),
+                "user_id": str(uuid.uuid4()),
+                "price": round(random.uniform(1, 100), 2),
+                "genre": random.choice(GENRES),
+                "trace_id": str(uuid.uuid4())
+            }
+        })
+    return events
+
+
+def make_rules(count):
+    """ count rules cycling through every rule type """
+    templates = [
+        {"type": "threshold", "event_type": "buy", "anomaly_type": "Too Low", "op": "<=", "value": 4},
+        {"type": "threshold", "event_type": "sell", "anomaly_type": "Too High", "op": ">=", "value": 90},
+        {"type": "genre", "event_type": "sell", "genre": "Mystery", "anomaly_type": "Too High",
+         "op": ">=", "value": 80},
+        {"type": "book_id", "event_type": "buy", "book_ids": list(range(1, 5000, 50)),
+         "anomaly_type": "Too Low", "op": "<=", "value": 10},
+        {"type": "zscore", "event_type": "sell", "anomaly_type": "Outlier", "window": 1000,
+         "threshold": 3}
+    ]
+    return [dict(templates[i % len(templates)], description="{price}") for i in range(count)]
+
+
+def per_event_checks(events):
+    """ The hard-coded checks of the consumer loop before the rule engine """
+    found = 0
+    for event in events:
+        price = event["payload"]["price"]
+        if event["type"] == "buy" and price <= 4:
+            found += 1
+        elif event["type"] == "sell" and price >= 90:
+            found += 1
+    return found
+
+
+def throughput(evaluate, events, batch_size):
+    """ Events per second of evaluate over events in batches of batch_size """
+    started = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        evaluate(events[i:i + batch_size])
+    return len(events) / (time.perf_counter() - started)
+
+
+def run(event_count, batch_size, rule_counts):
+    """ Prints events/sec per number of rules """
+    events = make_events(event_count)
+    baseline = throughput(per_event_checks, events, batch_size)
+    print(f"{'rules':>6} {'events/sec':>12}  engine")
+    print(f"{2:>6} {baseline:>12,.0f}  per-event checks")
+    for count in rule_counts:
+        engine = RuleEngine(make_rules(count))
+        rate = throughput(engine.evaluate, events, batch_size)
+        print(f"{count:>6} {rate:>12,.0f}  vectorized, batch size {batch_size}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the anomaly rule engine")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--rules", type=int, nargs="+", default=[1, 2, 5, 10, 20, 50])
+    args = parser.parse_args()
+    run(args.events, args.batch_size, args.rules)
@@ -0,0 +1,231 @@
+"""
+Anomaly Rule Engine
+
+Rules are loaded from the 'rules' list of app_conf.yml and evaluated on
+micro-batches of events. Each batch is turned into NumPy columns once, and
+every rule computes a boolean mask over the whole batch, so adding a rule
+adds a few vectorized comparisons rather than a Python branch per event.
+"""
+
+from functools import cached_property
+import numpy as np
+
+OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal
+}
+
+
+class EventBatch:
+    """ Columns of a micro-batch of events as NumPy arrays, built on first
+    use, and the masks shared by several rules, computed once per batch """
+
+    def __init__(self, events):
+        """
+        Args:
+            events (list): Decoded events with 'type' and 'payload' keys.
+        """
+        self.events = events
+        self.payloads = [event['payload'] for event in events]
+        self._type_masks = {}
+        self._genre_masks = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    @cached_property
+    def price(self):
+        return np.fromiter((payload.get('price', np.nan) for payload in self.payloads),
+                           dtype=np.float64, count=len(self.payloads))
+
+    @cached_property
+    def book_id(self):
+        return np.fromiter((payload.get('book_id', -1) for payload in self.payloads),
+                           dtype=np.int64, count=len(self.payloads))
+
+    def type_mask(self, event_type):
+        """ Boolean array of the events of a type """
+        if event_type not in self._type_masks:
+            self._type_masks[event_type] = np.fromiter(
+                (event['type'] == event_type for event in self.events), dtype=bool, count=len(self.events))
+        return self._type_masks[event_type]
+
+    def genre_mask(self, genre):
+        """ Boolean array of the events of a genre """
+        if genre not in self._genre_masks:
+            self._genre_masks[genre] = np.fromiter(
+                (payload.get('genre') == genre for payload in self.payloads), dtype=bool, count=len(self.payloads))
+        return self._genre_masks[genre]
+
+
+class Rule:
+    """ Base rule, matches the events of one event type """
+
+    def __init__(self, config):
+        self.event_type = config.get('event_type')
+        self.anomaly_type = config['anomaly_type']
+        self.description = config['description']
+
+    def mask(self, batch):
+        """ Boolean array of the events of the batch the rule applies to """
+        if self.event_type is None:
+            return np.ones(len(batch), dtype=bool)
+        return batch.type_mask(self.event_type)
+
+    def describe(self, event):
+        """ Human readable description of an anomaly found by the rule """
+        return self.description.format(price=event['payload'].get('price'), **self.__dict__)
+
+
+class ThresholdRule(Rule):
+    """ Price compared against a fixed value """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.op = config['op']
+        self.value = config['value']
+        self._compare = OPERATORS[self.op]
+
+    def mask(self, batch):
+        return super().mask(batch) & self._compare(batch.price, self.value)
+
+
+class GenreRule(ThresholdRule):
+    """ Price threshold for the events of one genre """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.genre = config['genre']
+
+    def mask(self, batch):
+        return super().mask(batch) & batch.genre_mask(self.genre)
+
+
+class BookIdRule(ThresholdRule):
+    """ Price threshold for the events of a set of books """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.book_ids = np.unique(np.array(config['book_ids'], dtype=np.int64))
+
+    def mask(self, batch):
+        # Binary search in the sorted ids, cheaper than np.isin for every batch
+        positions = np.searchsorted(self.book_ids, batch.book_id)
+        np.minimum(positions, len(self.book_ids) - 1, out=positions)
+        return super().mask(batch) & (self.book_ids[positions] == batch.book_id)
+
+
+class ZScoreRule(Rule):
+    """ Price more than 'threshold' standard deviations from the rolling
+    mean of the last 'window' prices of the event type """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.window = config['window']
+        self.threshold = config['threshold']
+        self.min_samples = config.get('min_samples', 30)
+        self._prices = np.zeros(self.window, dtype=np.float64)
+        self._count = 0
+        self._position = 0
+        # Running sums of the window, so a batch costs O(batch) not O(window)
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def mask(self, batch):
+        selected = super().mask(batch) & ~np.isnan(batch.price)
+        prices = batch.price[selected]
+        result = np.zeros(len(batch), dtype=bool)
+
+        # Each batch is scored against the window before it, then added to it
+        filled = min(self._count, self.window)
+        if filled >= self.min_samples and len(prices):
+            mean = self._sum / filled
+            std = np.sqrt(max(self._sum_squares / filled - mean * mean, 0.0))
+            if std > 0:
+                result[selected] = np.abs(prices - mean) >= self.threshold * std
+        self._update(prices)
+        return result
+
+    def _update(self, prices):
+        """ Adds prices to the ring buffer of the rolling window """
+        prices = prices[-self.window:]
+        if not len(prices):
+            return
+        slots = (self._position + np.arange(len(prices))) % self.window
+        if self._count >= self.window:
+            replaced = self._prices[slots]
+        else:
+            replaced = self._prices[slots[slots < self._count]]
+        self._prices[slots] = prices
+        self._position = (self._position + len(prices)) % self.window
+        self._count += len(prices)
+        if self._position < len(prices):
+            # Recompute the sums once per lap of the ring to drop rounding drift
+            window = self._prices[:min(self._count, self.window)]
+            self._sum = window.sum()
+            self._sum_squares = np.dot(window, window)
+        else:
+            self._sum += prices.sum() - replaced.sum()
+            self._sum_squares += np.dot(prices, prices) - np.dot(replaced, replaced)
+
+
+RULE_TYPES = {
+    'threshold': ThresholdRule,
+    'genre': GenreRule,
+    'book_id': BookIdRule,
+    'zscore': ZScoreRule
+}
+
+
+def threshold_rules(thresholds):
+    """ The rules equivalent to the 'thresholds' section of configs from
+    before the rule engine: buys at or below low_value are Too Low, sells
+    at or above high_value are Too High """
+    return [
+        {
+            'type': 'threshold',
+            'event_type': 'buy',
+            'anomaly_type': 'Too Low',
+            'op': '<=',
+            'value': thresholds['low_value'],
+            'description': "Buy price too low: {price} falls below {value}"
+        },
+        {
+            'type': 'threshold',
+            'event_type': 'sell',
+            'anomaly_type': 'Too High',
+            'op': '>=',
+            'value': thresholds['high_value'],
+            'description': "Sell price too high: {price} exceeds {value}"
+        }
+    ]
+
+
+class RuleEngine:
+    """ Evaluates a list of rules on micro-batches of events """
+
+    def __init__(self, rule_configs):
+        """
+        Args:
+            rule_configs (list): Rule definitions, each with a 'type' key.
+        """
+        self.rules = [RULE_TYPES[config['type']](config) for config in rule_configs]
+
+    def evaluate(self, events):
+        """
+        Finds the anomalies in a micro-batch of events.
+
+        Returns:
+            list: (event, rule) pairs, in event order.
+        """
+        if not events:
+            return []
+        batch = EventBatch(events)
+        matches = []
+        for rule in self.rules:
+            for position in np.flatnonzero(rule.mask(batch)):
+                matches.append((int(position), rule))
+        matches.sort(key=lambda match: match[0])
+        return [(events[position], rule) for position, rule in matches]
@@ -3,9 +3,16 @@ import logging
 import logging.config
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
+from collections import deque
+from threading import Lock
+import datetime
 import os
 import json
+import math
+import time
 import yaml
+import codec
+import validation
 from requests.exceptions import Timeout, ConnectionError
 
 # Determine the environment and load appropriate configuration files
@@ -34,91 +41,99 @@ logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 # Extract configuration values
-RECEIVER_URL = app_config['eventstore']['receiver']
-STORAGE_URL = app_config['eventstore']['storage']
-PROCESSING_URL = app_config['eventstore']['processing']
-ANALYZER_URL = app_config['eventstore']['analyzer']
+SERVICES = ("receiver", "storage", "processing", "analyzer")
 TIMEOUT = app_config['threshold']['timeout']
+PERIOD_SEC = app_config['scheduler']['period_sec']
 DATA_STORE = app_config['data_store']['filename']
+# Latencies kept per service for the p50/p95
+HISTORY_SIZE = app_config.get('history', {}).get('size', 100)
+
+def probe_config(name):
+    """ URL, timeout and interval of a service's probe. An optional
+    probes.<service> section with timeout and period_sec overrides the
+    shared threshold.timeout and scheduler.period_sec """
+    overrides = app_config.get('probes', {}).get(name, {})
+    return {
+        "url": app_config['eventstore'][name],
+        "timeout": overrides.get('timeout', TIMEOUT),
+        "period_sec": overrides.get('period_sec', PERIOD_SEC)
+    }
 
-def check_services():
-    """Check the health of various services and log their status periodically."""
-
-    logger.info("Starting health check for all services.")
-
-    # Ensure datastore exists
-    if not os.path.exists(DATA_STORE):
-        logger.info(f"Creating data store: {DATA_STORE}")
-        with open(DATA_STORE, 'w') as f:
-            json.dump([], f)
-
-    # Check Receiver service
-    receiver_status = "Unavailable"
-    try:
-        logger.info("Checking Receiver service health.")
-        response = requests.get(RECEIVER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            receiver_status = "Healthy"
-            logger.info("Receiver service is healthy.")
-        else:
-            logger.warning("Receiver service returned a non-200 response.")
-    except (Timeout, ConnectionError):
-        logger.error("Receiver service is not available.")
-
-    # Check Storage service
-    storage_status = "Unavailable"
-    try:
-        logger.info("Checking Storage service health.")
-        response = requests.get(STORAGE_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            storage_json = response.json()
-            storage_status = f"Storage has {storage_json['num_buy_events']} Buy Events and {storage_json['num_sell_events']} Sell events"
-            logger.info("Storage service is healthy.")
-        else:
-            logger.warning("Storage service returned a non-200 response.")
-    except (Timeout, ConnectionError):
-        logger.error("Storage service is not available.")
-
-    # Check Analyzer service
-    analyzer_status = "Unavailable"
-    try:
-        logger.info("Checking Analyzer service health.")
-        response = requests.get(ANALYZER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            analyzer_json = response.json()
-            analyzer_status = f"Analyzer has {analyzer_json['num_buy_events']} Buy Events and {analyzer_json['num_sell_events']} Sell events"
-            logger.info("Analyzer service is healthy.")
-        else:
-            logger.warning("Analyzer service returned a non-200 response.")
-    except (Timeout, ConnectionError):
-        logger.error("Analyzer service is not available.")
+PROBES = {name: probe_config(name) for name in SERVICES}
+
+# Shared by the probes, so each service is checked over a kept-alive connection
+SESSION = requests.Session()
+
+STATUS_LOCK = Lock()
+STATUS = {name: "Unavailable" for name in SERVICES}
+LATENCIES = {name: deque(maxlen=HISTORY_SIZE) for name in SERVICES}
+LAST_CHECKED = {name: None for name in SERVICES}
+
+def describe(name, response):
+    """ Status of a service from its healthy response """
+    if name == "receiver":
+        return "Healthy"
+    stats = codec.loads(response.content)
+    return f"{name.capitalize()} has {stats['num_buy_events']} Buy Events and {stats['num_sell_events']} Sell events"
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of sorted values, None if there are none """
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values)) - 1
+    return sorted_values[min(len(sorted_values) - 1, max(0, rank))]
+
+def latency_summary(name):
+    """ p50/p95 of the recent probe latencies of a service """
+    latencies = sorted(LATENCIES[name])
+    return {
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "last": LATENCIES[name][-1] if LATENCIES[name] else None,
+        "samples": len(latencies),
+        "last_checked": LAST_CHECKED[name]
+    }
 
-    # Check Processing service
-    processing_status = "Unavailable"
+def write_status():
+    """ Replaces the status file with the current statuses in one step, so
+    readers never see a partly written file """
+    status = dict(STATUS)
+    status["latency_ms"] = {name: latency_summary(name) for name in SERVICES}
+    temp_file = f"{DATA_STORE}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(status, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, DATA_STORE)
+
+def probe_service(name):
+    """Check the health of a service and record its status and latency."""
+    probe = PROBES[name]
+    label = name.capitalize()
+    status = "Unavailable"
+    latency_ms = None
+    logger.info(f"Checking {label} service health.")
+    started = time.monotonic()
     try:
-        logger.info("Checking Processing service health.")
-        response = requests.get(PROCESSING_URL, timeout=TIMEOUT)
+        response = SESSION.get(probe['url'], timeout=probe['timeout'])
+        latency_ms = round((time.monotonic() - started) * 1000, 3)
         if response.status_code == 200:
-            processing_json = response.json()
-            processing_status = f"Processing has {processing_json['num_buy_events']} Buy Events and {processing_json['num_sell_events']} Sell events"
-            logger.info("Processing service is healthy.")
+            status = describe(name, response)
+            logger.info(f"{label} service is healthy.")
         else:
-            logger.warning("Processing service returned a non-200 response.")
+            logger.warning(f"{label} service returned a non-200 response.")
     except (Timeout, ConnectionError):
-        logger.error("Processing service is not available.")
-
-    # Log the overall status and write to the datastore
-    status = {
-        "receiver": receiver_status,
-        "storage": storage_status,
-        "processing": processing_status,
-        "analyzer": analyzer_status
-    }
-
-    logger.info("Writing service status to datastore.")
-    with open(DATA_STORE, "w") as file:
-        json.dump(status, file, indent=2)
-    logger.info("Health check completed.")
+        logger.error(f"{label} service is not available.")
+    except (ValueError, KeyError):
+        logger.warning(f"{label} service returned an unexpected response.")
+
+    with STATUS_LOCK:
+        STATUS[name] = status
+        if latency_ms is not None:
+            LATENCIES[name].append(latency_ms)
+        LAST_CHECKED[name] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        write_status()
+    logger.info(f"{label} health check completed.")
 
 def get_checks():
     """Retrieve the last recorded health check statuses."""
@@ -137,20 +152,32 @@ def init_scheduler():
     """Initialize and start the scheduler for periodic health checks."""
     logger.info("Initializing scheduler for periodic health checks.")
 
+    # One job per service, so the probes run concurrently in the scheduler's
+    # thread pool, each at its own interval, starting right away
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(check_services,
-                  'interval',
-                  seconds=app_config['scheduler']['period_sec'])
+    for name, probe in PROBES.items():
+        sched.add_job(probe_service,
+                      'interval',
+                      args=[name],
+                      seconds=probe['period_sec'],
+                      next_run_time=datetime.datetime.now())
     sched.start()
     logger.info("Scheduler started successfully.")
 
+def get_validation_stats():
+    """ Gets the response validation policy and what it validated """
+    return validation.POLICY.stats(), 200
+
 # Initialize the Connexion app
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/check", strict_validation=True, validate_responses=True)
+validation.configure(app_config.get('validation'))
+app = connexion.FlaskApp(__name__, specification_dir='', jsonifier=codec.CodecJsonifier())
+app.add_api("openapi.yml", base_path="/check", strict_validation=True, validate_responses=True,
+            validator_map=validation.VALIDATOR_MAP)
 
 if __name__ == "__main__":
     # Start the application
     logger.info("Starting the Flask application.")
+    logger.info(f"Compiled {validation.prebuild(app)} schema validators")
     init_scheduler()
     app.run(host="0.0.0.0", port=8130)
     logger.info("Flask application is running.")
\ No newline at end of file
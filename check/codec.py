@@ -0,0 +1,238 @@
+"""
+JSON codec of the event messages and HTTP bodies
+
+Uses the fastest JSON library installed, orjson, then msgspec, falling
+back on the standard library, so every service encodes and decodes the
+same way whatever its image has installed. The event types are TypedDicts,
+so decoded events stay plain dicts for the code that handles them.
+
+Events topic messages can also be encoded in a compact binary format, a
+version byte, a type byte and the fields of the event type in a fixed
+layout. JSON messages start with '{', so decode_event tells the formats
+apart from the first byte.
+"""
+
+import datetime
+import decimal
+import functools
+import json
+import struct
+import uuid
+from typing import Any, Dict, TypedDict
+
+from connexion.jsonifier import Jsonifier
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class BuyEvent(TypedDict):
+    """ Payload of a buy event """
+    order_id: str
+    book_id: int
+    user_id: str
+    name: str
+    price: float
+    sold: bool
+    trace_id: str
+
+
+class SellEvent(TypedDict):
+    """ Payload of a sell event """
+    book_id: int
+    user_id: str
+    name: str
+    listing_date: str
+    price: float
+    genre: str
+    trace_id: str
+
+
+class Event(TypedDict):
+    """ Message of the events topic, the payload is a BuyEvent or SellEvent """
+    type: str
+    datetime: str
+    payload: Dict[str, Any]
+
+
+def _default(value):
+    """ Serializes the types the standard library does not, the way
+    connexion's default encoder did: naive datetimes are UTC with a Z """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat("T") if value.tzinfo is not None else value.isoformat("T") + "Z"
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_dumps(obj):
+    """ Encodes an object to JSON bytes with the standard library """
+    return json.dumps(obj, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+# The fast backends' functions are bound directly, so a call costs no more
+# than calling the library
+if orjson is not None:
+    BACKEND = "orjson"
+    # Datetimes go through _default, orjson would drop the Z of naive ones
+    dumps = functools.partial(orjson.dumps, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    _dumps_event = dumps
+    loads = orjson.loads
+    decode_event = orjson.loads
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    # msgspec drops the Z of naive datetimes and has no hook for the types it
+    # supports, so bodies are encoded with the standard library. Event
+    # messages hold no datetime objects and keep the msgspec encoder.
+    dumps = _json_dumps
+    _dumps_event = msgspec.json.Encoder().encode
+    loads = msgspec.json.Decoder().decode
+    # Checks the message envelope while decoding, the payload stays a dict
+    decode_event = msgspec.json.Decoder(Event).decode
+
+else:
+    BACKEND = "json"
+    dumps = _json_dumps
+    _dumps_event = dumps
+
+    def loads(data):
+        """ Decodes JSON bytes or str """
+        return json.loads(data)
+
+    def decode_event(data):
+        """ Decodes a message of the events topic """
+        return json.loads(data)
+
+
+_decode_json_event = decode_event
+
+# Binary format version 1: the version and type bytes, the datetime, the
+# fixed size fields, then the lengths of the strings and the strings. Ids
+# and datetimes are kept as text, so decoding is slicing, not parsing.
+BINARY_V1 = 1
+BINARY_BUY = 1
+BINARY_SELL = 2
+_BUY_V1 = struct.Struct(">BB19s36s36s36sid?H")
+_SELL_V1 = struct.Struct(">BB19s36s36sidHHH")
+_BUY_FIELDS = {"order_id", "book_id", "user_id", "name", "price", "sold", "trace_id"}
+_SELL_FIELDS = {"book_id", "user_id", "name", "listing_date", "price", "genre", "trace_id"}
+
+
+def _ids(*values):
+    """ ASCII bytes of ids, None if any is not a 36 character UUID string,
+    as struct would silently pad or truncate it """
+    encoded = [value.encode("ascii") for value in values]
+    return encoded if all(len(value) == 36 for value in encoded) else None
+
+
+def _encode_binary(event_type, timestamp, payload):
+    """ Encodes an event in binary format version 1, or returns None if
+    the payload does not fit the layout of its type exactly """
+    try:
+        if event_type == "buy" and payload.keys() == _BUY_FIELDS:
+            ids = _ids(payload["order_id"], payload["user_id"], payload["trace_id"])
+            if ids is None:
+                return None
+            name = payload["name"].encode("utf-8")
+            return _BUY_V1.pack(BINARY_V1, BINARY_BUY, timestamp.encode("ascii"), *ids,
+                                payload["book_id"], payload["price"], payload["sold"], len(name)) + name
+        if event_type == "sell" and payload.keys() == _SELL_FIELDS:
+            ids = _ids(payload["user_id"], payload["trace_id"])
+            if ids is None:
+                return None
+            name = payload["name"].encode("utf-8")
+            listing_date = payload["listing_date"].encode("utf-8")
+            genre = payload["genre"].encode("utf-8")
+            return _SELL_V1.pack(BINARY_V1, BINARY_SELL, timestamp.encode("ascii"), *ids,
+                                 payload["book_id"], payload["price"],
+                                 len(name), len(listing_date), len(genre)) + name + listing_date + genre
+    except (AttributeError, UnicodeEncodeError, struct.error):
+        pass
+    return None
+
+
+def _decode_binary(data):
+    """ Decodes an event in binary format version 1 """
+    if data[1] == BINARY_BUY:
+        (_, _, timestamp, order_id, user_id, trace_id,
+         book_id, price, sold, name_size) = _BUY_V1.unpack_from(data)
+        position = _BUY_V1.size
+        payload = {
+            "order_id": order_id.decode(),
+            "book_id": book_id,
+            "user_id": user_id.decode(),
+            "name": data[position:position + name_size].decode(),
+            "price": price,
+            "sold": sold,
+            "trace_id": trace_id.decode()
+        }
+        return {"type": "buy", "datetime": timestamp.decode(), "payload": payload}
+
+    (_, _, timestamp, user_id, trace_id, book_id, price,
+     name_size, listing_date_size, genre_size) = _SELL_V1.unpack_from(data)
+    name_end = _SELL_V1.size + name_size
+    listing_date_end = name_end + listing_date_size
+    payload = {
+        "book_id": book_id,
+        "user_id": user_id.decode(),
+        "name": data[_SELL_V1.size:name_end].decode(),
+        "listing_date": data[name_end:listing_date_end].decode(),
+        "price": price,
+        "genre": data[listing_date_end:listing_date_end + genre_size].decode(),
+        "trace_id": trace_id.decode()
+    }
+    return {"type": "sell", "datetime": timestamp.decode(), "payload": payload}
+
+
+def decode_event(data):
+    """ Decodes a message of the events topic, in JSON or binary format """
+    if data[0] == BINARY_V1:
+        return _decode_binary(data)
+    return _decode_json_event(data)
+
+
+def dumps_str(obj):
+    """ Encodes an object to a JSON str """
+    return dumps(obj).decode("utf-8")
+
+
+def encode_event(event_type, payload, binary=False):
+    """ Encodes a message of the events topic, in binary format if asked
+    and the payload fits it, in JSON otherwise """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    if binary:
+        data = _encode_binary(event_type, timestamp, payload)
+        if data is not None:
+            return data
+    return _dumps_event({
+        "type": event_type,
+        "datetime": timestamp,
+        "payload": payload
+    })
+
+
+class CodecJsonifier(Jsonifier):
+    """ Connexion jsonifier that serializes request and response bodies
+    with the codec's backend """
+
+    def dumps(self, data, **kwargs):
+        return dumps_str(data) + "\n"
+
+    def loads(self, data):
+        try:
+            return loads(data)
+        except ValueError:
+            # Connexion passes non-JSON bodies through as text
+            return data.decode() if isinstance(data, bytes) else data
@@ -1,5 +1,13 @@
 import React, { useEffect, useState } from 'react';
 import '../App.css';
+import { subscribe } from '../eventStreams';
+
+const STATS_STREAM = `http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/processing/stats/stream`;
+const ANOMALY_STREAM = `http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/anomaly_detector/anomalies/stream`;
+
+// Keeps the newer of two anomalies
+const latest = (anomaly) => (current) =>
+    !current || new Date(anomaly.timestamp) > new Date(current.timestamp) ? anomaly : current;
 
 export default function AppStats() {
     const [isLoaded, setIsLoaded] = useState(false);
@@ -8,62 +16,29 @@ export default function AppStats() {
     const [sellAnomaly, setSellAnomaly] = useState(null);
     const [error, setError] = useState(null);
 
-    // Fetch Stats
-    const getStats = () => {
-        fetch(`http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com:/processing/stats`)
-            .then((res) => res.json())
-            .then(
-                (result) => {
-                    console.log("Received Stats");
-                    setStats(result);
-                    setIsLoaded(true);
-                },
-                (error) => {
-                    setError(error);
-                    setIsLoaded(true);
-                }
-            );
-    };
-
-    // Fetch Anomalies
-    const getAnomalies = () => {
-        // Fetch 'Too Low' anomalies for buy events
-        fetch(`http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/anomaly_detector/anomalies?anomaly_type=TooLow`)
-            .then((res) => res.json())
-            .then((result) => {
-                console.log("Received Low Anomalies");
-                const buyAnomalies = result.filter((anomaly) => anomaly.event_type === 'buy');
-                if (buyAnomalies.length > 0) {
-                    const latestBuyAnomaly = buyAnomalies.reduce((latest, anomaly) =>
-                        new Date(anomaly.timestamp) > new Date(latest.timestamp) ? anomaly : latest
-                    );
-                    setBuyAnomaly(latestBuyAnomaly);
-                }
-            })
-            .catch((error) => setError(error));
+    useEffect(() => {
+        // The stats stream sends the whole stats on connect, then the fields that changed
+        const unsubscribeStats = subscribe(STATS_STREAM, 'stats', (update) => {
+            console.log("Received Stats");
+            setStats((current) => ({ ...current, ...update }));
+            setIsLoaded(true);
+        }, setError);
 
-        // Fetch 'Too High' anomalies for sell events
-        fetch(`http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/anomaly_detector/anomalies?anomaly_type=TooHigh`)
-            .then((res) => res.json())
-            .then((result) => {
-                console.log("Received High Anomalies");
-                const sellAnomalies = result.filter((anomaly) => anomaly.event_type === 'sell');
-                if (sellAnomalies.length > 0) {
-                    const latestSellAnomaly = sellAnomalies.reduce((latest, anomaly) =>
-                        new Date(anomaly.timestamp) > new Date(latest.timestamp) ? anomaly : latest
-                    );
-                    setSellAnomaly(latestSellAnomaly);
-                }
-            })
-            .catch((error) => setError(error));
-    };
+        // The anomaly stream sends the latest anomalies on connect, then each new one
+        const unsubscribeAnomalies = subscribe(ANOMALY_STREAM, 'anomaly', (anomaly) => {
+            if (anomaly.anomaly_type === 'Too Low' && anomaly.event_type === 'buy') {
+                console.log("Received Low Anomaly");
+                setBuyAnomaly(latest(anomaly));
+            } else if (anomaly.anomaly_type === 'Too High' && anomaly.event_type === 'sell') {
+                console.log("Received High Anomaly");
+                setSellAnomaly(latest(anomaly));
+            }
+        }, setError);
 
-    useEffect(() => {
-        const interval = setInterval(() => {
-            getStats();
-            getAnomalies();
-        }, 5000); // Fetch stats and anomalies every 5 seconds
-        return () => clearInterval(interval);
+        return () => {
+            unsubscribeStats();
+            unsubscribeAnomalies();
+        };
     }, []);
 
     if (error) {
@@ -1,30 +1,53 @@
 import React, { useEffect, useState } from 'react'
 import '../App.css';
+import { subscribe } from '../eventStreams';
+
+const STATS_STREAM = `http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/processing/stats/stream`;
+// Stats are pushed up to every second, events are fetched at most this often
+const REFETCH_INTERVAL_MS = 4000;
 
 export default function EndpointAnalyzer(props) {
     const [isLoaded, setIsLoaded] = useState(false);
     const [log, setLog] = useState(null);
     const [error, setError] = useState(null)
-	const rand_val = Math.floor(Math.random() * 100); // Get a random event from the event store
     const [index, setIndex] = useState(null);
 
-    const getAnalyzer = () => {
-        fetch(`http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/analyzer/books/${props.endpoint}?index=${rand_val}`)
-            .then(res => res.json())
-            .then((result)=>{
-				console.log("Received Analyzer Results for " + props.endpoint)
-                setLog(result);
-                setIndex(rand_val);
-                setIsLoaded(true);
-            },(error) =>{
-                setError(error)
-                setIsLoaded(true);
-            })
-    }
 	useEffect(() => {
-		const interval = setInterval(() => getAnalyzer(), 4000); // Update every 4 seconds
-		return() => clearInterval(interval);
-    }, [getAnalyzer]);
+        let count = null; // Latest count of events of this type
+        let lastFetch = 0;
+        let timer = null;
+        const getAnalyzer = () => {
+            timer = null;
+            lastFetch = Date.now();
+            const rand_val = Math.floor(Math.random() * (count || 100)); // Get a random event from the event store
+            fetch(`http://acit-3855-mysql-kafka.francecentral.cloudapp.azure.com/analyzer/books/${props.endpoint}?index=${rand_val}`)
+                .then(res => res.json())
+                .then((result)=>{
+                    console.log("Received Analyzer Results for " + props.endpoint)
+                    setLog(result);
+                    setIndex(rand_val);
+                    setIsLoaded(true);
+                },(error) =>{
+                    setError(error)
+                    setIsLoaded(true);
+                })
+        }
+        getAnalyzer();
+        // Fetch another event when events of this type arrive, instead of on
+        // a timer, once the interval since the last fetch has passed
+        const unsubscribe = subscribe(STATS_STREAM, 'stats', (update) => {
+            if (`num_${props.endpoint}_events` in update) {
+                count = update[`num_${props.endpoint}_events`];
+                if (timer === null) {
+                    timer = setTimeout(getAnalyzer, Math.max(0, lastFetch + REFETCH_INTERVAL_MS - Date.now()));
+                }
+            }
+        }, setError);
+        return () => {
+            unsubscribe();
+            clearTimeout(timer);
+        };
+    }, [props.endpoint]);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
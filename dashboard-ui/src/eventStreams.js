@@ -0,0 +1,32 @@
+// One EventSource per stream URL, shared by the components subscribed to it.
+// The services send the current state when a stream connects, so a component
+// subscribing to a stream that is already open only gets the later updates.
+const streams = {};
+
+export function subscribe(url, eventType, onEvent, onError) {
+    let stream = streams[url];
+    if (!stream) {
+        stream = streams[url] = { source: new EventSource(url), subscribers: 0 };
+    }
+    stream.subscribers += 1;
+
+    const handleEvent = (message) => onEvent(JSON.parse(message.data));
+    const handleError = () => {
+        // EventSource reconnects by itself unless the stream was closed for good
+        if (onError && stream.source.readyState === EventSource.CLOSED) {
+            onError(new Error(`Stream ${url} closed`));
+        }
+    };
+    stream.source.addEventListener(eventType, handleEvent);
+    stream.source.addEventListener('error', handleError);
+
+    return () => {
+        stream.source.removeEventListener(eventType, handleEvent);
+        stream.source.removeEventListener('error', handleError);
+        stream.subscribers -= 1;
+        if (stream.subscribers === 0) {
+            stream.source.close();
+            delete streams[url];
+        }
+    };
+}